@@ -1,16 +1,53 @@
 import rasterio
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+from scipy import sparse
 import pandas as pd
 import numpy as np
-import h3
 import os
 import re
-from functools import reduce
+import hashlib
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from h3_utils import H3_RESOLUTION, geo_to_h3_array, h3_column_to_str, raise_on_failures, EXPORT_H3_AS_STRING
 
 RAW_DATA_DIR = '../../data/raw'
 PROCESSED_DATA_DIR = '../../data/processed'
 
 AGE_DEMOGRAPHICS_DIR = 'KEN_population_v2_0_agesex'
 
+# Whether to stream the rasters by block windows (bounded memory) instead of reading whole bands
+STREAMING = False
+
+# Number of worker processes processing the rasters in parallel, None to use all the cores
+WORKERS = 1
+
+# Per-pixel and per-cell dataframes of every band are only saved for debugging, in a compressed
+# columnar format ('feather' or 'parquet') that can be read back memory-mapped
+SAVE_INTERMEDIATES = False
+INTERMEDIATE_FORMAT = 'feather'
+INTERMEDIATE_COMPRESSION = 'zstd'
+
+# Directory where the pixel to h3 mappings of the raster grids are cached
+GRID_INDEX_CACHE_DIR = '../output/grid_index_cache'
+GRID_INDEX_ROWS_PER_CHUNK = 512
+
+# Number of samples per pixel side used to apportion every pixel to the h3 cells it overlaps
+PIXEL_SUBSAMPLES = 4
+
+# Number of pending per-window partial sums after which they are merged when streaming rasters
+STREAMING_COMPACT_THRESHOLD = 1_000_000
+
+# Per-band h3 aggregates cached by content hash of the raster and processing parameters, so that
+# re-runs only recompute the bands that changed. Bump NODATA_HANDLING when the masking changes.
+USE_BUILD_CACHE = True
+BUILD_CACHE_DIR = '../output/build_cache'
+NODATA_HANDLING = 'mask_nodata_and_nan'
+
+# Grid index of the current process, shared by all the bands using the same grid
+_grid_index = None
+
 def get_file_names(directory):
     """Gets the names of all files in a directory."""
     file_names = []
@@ -42,79 +79,490 @@ def filter_files(file_names):
     return result
 
 
-def extract_tif_data(filename, file_feature):
-    with rasterio.open(filename) as src:
-            band1 = src.read(1)  # Read the first band (population data)
-            transform = src.transform  # Get the affine transformation
+def get_pixel_centers(transform, rows, cols):
+    """
+    Convert arrays of pixel indices into the geographic coordinates of the pixel centers.
+
+    Parameters:
+    transform (affine.Affine): Affine transformation of the raster
+    rows (numpy.ndarray): Row index of every pixel
+    cols (numpy.ndarray): Column index of every pixel
+
+    Returns:
+    tuple: Arrays of longitudes and latitudes of the pixel centers
+    """
+    # (x, y) = transform * (col, row), shifted by half a pixel to land on the center
+    col_centers = cols + 0.5
+    row_centers = rows + 0.5
+    lon = transform.a * col_centers + transform.b * row_centers + transform.c
+    lat = transform.d * col_centers + transform.e * row_centers + transform.f
+    return lon, lat
+
+def get_subpixel_centers(transform, rows, cols, subsamples):
+    """
+    Convert arrays of pixel indices into the coordinates of a subsamples x subsamples grid of
+    sample points evenly spread over every pixel (the pixel center when subsamples is 1).
 
-    # Prepare a list to hold the data
-    data = []
+    Returns:
+    tuple: Arrays of longitudes and latitudes, with the samples of a pixel stored contiguously
+    """
+    offsets = (np.arange(subsamples) + 0.5) / subsamples
+    row_offsets, col_offsets = np.meshgrid(offsets, offsets, indexing='ij')
+    sample_rows = (rows[:, None] + row_offsets.ravel()[None, :]).ravel()
+    sample_cols = (cols[:, None] + col_offsets.ravel()[None, :]).ravel()
+    # Shift back by half a pixel since get_pixel_centers adds it
+    return get_pixel_centers(transform, sample_rows - 0.5, sample_cols - 0.5)
 
-    # Get dimensions of the raster
-    height, width = band1.shape
+def get_valid_pixels_mask(band, nodata):
+    """Returns a boolean mask of the pixels holding data (not no-data and not NaN)."""
+    valid = ~np.isnan(band) if np.issubdtype(band.dtype, np.floating) else np.ones(band.shape, dtype=bool)
+    if nodata is not None and not np.isnan(nodata):
+        valid &= band != nodata
+    return valid
 
-    # Loop through each pixel in the raster
-    for row in range(height):
-        for col in range(width):
-            # Get the population value for this pixel
-            population_value = band1[row, col]
+def read_tif_band(filename):
+    """Reads the first band of a raster along with its affine transformation and no-data value."""
+    with rasterio.open(filename) as src:
+        band1 = src.read(1)  # Read the first band (population data)
+        transform = src.transform  # Get the affine transformation
+        nodata = src.nodata
+    return band1, transform, nodata
 
-            # Skip no-data values if necessary (depending on your raster)
-            if population_value != src.nodata:
-                # Convert pixel coordinates to geographic coordinates
-                lon, lat = transform * (col, row)  # (x, y) = (col, row)
+def band_to_df(band1, transform, nodata, file_feature):
+    """Creates a DataFrame with the value and the center coordinates of every valid pixel of a band."""
+    # Mask the no-data values for the whole band at once
+    valid = get_valid_pixels_mask(band1, nodata)
+    rows, cols = np.nonzero(valid)
 
-                # Append the data as a tuple
-                data.append((population_value, lon, lat))
-    # Create a DataFrame
-    df_population = pd.DataFrame(data, columns=[f'population_{file_feature}', 'lon', 'lat'])
+    # Convert pixel coordinates to geographic coordinates
+    lon, lat = get_pixel_centers(transform, rows, cols)
 
-    # Optionally, reset the index
-    df_population.reset_index(drop=True, inplace=True)
+    # Create a DataFrame
+    df_population = pd.DataFrame({
+        f'population_{file_feature}': band1[valid],
+        'lon': lon,
+        'lat': lat
+    })
     return df_population
 
+def extract_tif_data(filename, file_feature):
+    band1, transform, nodata = read_tif_band(filename)
+    return band_to_df(band1, transform, nodata, file_feature)
+
 
-def gis_df_to_h3_df(df, population_column_name):
+def gis_df_to_h3_df(df, population_column_name, resolution=H3_RESOLUTION):
     print(f'Processing df for {population_column_name}')
-    resolution = 8
-    try:
-        df_h3 = df.copy()
-        df_h3['h3'] = df.apply(lambda row: h3.geo_to_h3(row["lat"], row["lon"], resolution), axis = 1) 
-        df_h3_agg = df_h3.groupby("h3")[population_column_name].sum().reset_index() 
-        print("Successfuly created the h3 df")
-    except:
-        print("An error has occured while converting lat and lon to h3")
-    
+    # Assign the h3 cells in batch and sum the population of the pixels falling in each cell
+    cells = geo_to_h3_array(df['lat'].to_numpy(), df['lon'].to_numpy(), resolution)
+    unique_cells, inverse = np.unique(cells, return_inverse=True)
+    population_sums = np.bincount(inverse, weights=df[population_column_name].to_numpy(), minlength=len(unique_cells))
+
+    df_h3_agg = pd.DataFrame({
+        'h3': unique_cells,
+        population_column_name: population_sums
+    })
+    print("Successfuly created the h3 df")
     return df_h3_agg
 
-def create_df_list_from_directory(file_names_dict):
-    # Open the raster file
-    df_list = []
-    for filename in file_names_dict:
-        try:
-            print(f'Processing file: {filename}')
-            filepath = os.path.join(RAW_DATA_DIR, AGE_DEMOGRAPHICS_DIR, filename)
-            df_file = extract_tif_data(filepath, file_names_dict[filename])
+class GridIndex:
+    """
+    Sparse weights apportioning the pixels of a raster grid to the h3 cells they overlap.
+
+    Every pixel is sampled on a subsamples x subsamples sub-grid, so the weight of a pixel in a
+    cell is the fraction of its area covered by that cell (with subsamples=1, a pixel goes
+    entirely to the cell containing its center). All the age/sex rasters share the same grid,
+    so the weights are computed once (and cached on disk, keyed by the transform, shape,
+    resolution and subsamples) and every band is aggregated with one sparse matrix-vector product.
+
+    Attributes:
+    transform (affine.Affine): Affine transformation of the grid
+    shape (tuple): (height, width) of the grid
+    resolution (int): h3 resolution of the cells
+    subsamples (int): Number of samples per pixel side used to estimate the area overlaps
+    cells (numpy.ndarray): Sorted uint64 array of the distinct h3 cells covering the grid
+    weights (scipy.sparse.csr_matrix): float32 matrix (cells x pixels, row-major pixels) of area fractions
+    """
+    def __init__(self, transform, shape, resolution=H3_RESOLUTION, subsamples=PIXEL_SUBSAMPLES, cells=None, weights=None):
+        self.transform = transform
+        self.shape = tuple(shape)
+        self.resolution = resolution
+        self.subsamples = subsamples
+        self.cells = cells
+        self.weights = weights
+
+    @property
+    def cache_key(self):
+        key = f'{tuple(self.transform)[:6]}|{self.shape}|{self.resolution}|{self.subsamples}'
+        return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+    def matches(self, transform, shape):
+        return tuple(transform)[:6] == tuple(self.transform)[:6] and tuple(shape) == self.shape
+
+    def build(self, rows_per_chunk=GRID_INDEX_ROWS_PER_CHUNK):
+        """
+        Computes the weights a chunk of rows at a time, so that the sub-pixel samples are never
+        held for the whole grid.
+        """
+        print(f'[INFO] Building the pixel to h3 weights for a grid of shape {self.shape}...')
+        height, width = self.shape
+        samples_per_pixel = self.subsamples ** 2
+        rows_per_chunk = max(1, rows_per_chunk // samples_per_pixel)
+        chunk_cells = []
+        chunk_triplets = []
+        cols = np.arange(width)
+        for row_start in range(0, height, rows_per_chunk):
+            rows = np.arange(row_start, min(row_start + rows_per_chunk, height))
+            row_grid, col_grid = np.meshgrid(rows, cols, indexing='ij')
+            lon, lat = get_subpixel_centers(self.transform, row_grid.ravel(), col_grid.ravel(), self.subsamples)
+            cells, codes = np.unique(geo_to_h3_array(lat, lon, self.resolution), return_inverse=True)
+
+            # Count the samples of every (pixel, cell) pair of the chunk
+            local_pixels = np.repeat(np.arange(rows.size * width, dtype=np.int64), samples_per_pixel)
+            pairs, counts = np.unique(local_pixels * cells.size + codes, return_counts=True)
+            pixel_ids = pairs // cells.size + row_start * width
+            chunk_cells.append(cells)
+            chunk_triplets.append((pairs % cells.size, pixel_ids, counts))
+
+        # Remap the cell codes of every chunk to positions in the global sorted list of cells
+        self.cells = np.unique(np.concatenate(chunk_cells))
+        cell_positions = np.concatenate([
+            np.searchsorted(self.cells, cells)[codes]
+            for cells, (codes, _, _) in zip(chunk_cells, chunk_triplets)
+        ])
+        pixel_ids = np.concatenate([pixels for _, pixels, _ in chunk_triplets]).astype(np.int32)
+        fractions = np.concatenate([counts for _, _, counts in chunk_triplets]).astype(np.float32) / samples_per_pixel
+        self.weights = sparse.csr_matrix(
+            (fractions, (cell_positions, pixel_ids)),
+            shape=(self.cells.size, height * width)
+        )
+        print(f'[INFO] Grid index built: {height * width} pixels apportioned to {self.cells.size} h3 cells\n')
+        return self
+
+    def save(self, cache_path):
+        """Saves the cells and the weights as .npy files so that they can be memory-mapped."""
+        os.makedirs(cache_path, exist_ok=True)
+        np.save(os.path.join(cache_path, 'cells.npy'), self.cells)
+        np.save(os.path.join(cache_path, 'weights_data.npy'), self.weights.data)
+        np.save(os.path.join(cache_path, 'weights_indices.npy'), self.weights.indices)
+        np.save(os.path.join(cache_path, 'weights_indptr.npy'), self.weights.indptr)
+        print(f'[INFO] Grid index saved to {cache_path}')
+
+    @classmethod
+    def load_or_build(cls, transform, shape, resolution=H3_RESOLUTION, subsamples=PIXEL_SUBSAMPLES,
+                      cache_dir=GRID_INDEX_CACHE_DIR):
+        """
+        Loads the grid index from the cache directory if present, otherwise builds and caches it.
+        The weights are memory-mapped, so worker processes loading the same index share its pages.
+        """
+        grid_index = cls(transform, shape, resolution, subsamples)
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = os.path.join(cache_dir, f'grid_index_{grid_index.cache_key}')
+            if os.path.exists(os.path.join(cache_path, 'weights_indptr.npy')):
+                grid_index.cells = np.load(os.path.join(cache_path, 'cells.npy'))
+                weights_arrays = [
+                    np.load(os.path.join(cache_path, f'weights_{name}.npy'), mmap_mode='r')
+                    for name in ('data', 'indices', 'indptr')
+                ]
+                grid_index.weights = sparse.csr_matrix(
+                    tuple(weights_arrays),
+                    shape=(grid_index.cells.size, grid_index.shape[0] * grid_index.shape[1]),
+                    copy=False
+                )
+                print(f'[INFO] Grid index loaded from {cache_path}')
+                return grid_index
+
+        grid_index.build()
+        if cache_path is not None:
+            try:
+                grid_index.save(cache_path)
+            except Exception as e:
+                print(f"An error occurred while saving the grid index: {str(e)}")
+        return grid_index
+
+    def aggregate_band(self, band, nodata, population_column_name):
+        """
+        Apportions the valid pixels of a band sharing this grid to the h3 cells they overlap.
+
+        Parameters:
+        band (numpy.ndarray): 2D array of pixel values with the shape of the grid
+        nodata (float): No-data value of the band
+        population_column_name (str): Name of the output population column
+
+        Returns:
+        pandas.DataFrame: DataFrame with the uint64 h3 cells and the population apportioned to each cell
+        """
+        values = band.ravel()
+        valid = get_valid_pixels_mask(values, nodata)
+        population_sums = self.weights @ np.where(valid, values, 0).astype(np.float32)
+
+        # Only keep the cells overlapped by at least one valid pixel
+        has_pixels = (self.weights @ valid.astype(np.float32)) > 0
+        return pd.DataFrame({
+            'h3': self.cells[has_pixels],
+            population_column_name: population_sums[has_pixels]
+        })
+
+def merge_partial_sums(cells_list, sums_list):
+    """
+    Merges partial per-cell population sums into a single sorted list of cells and sums.
+
+    Parameters:
+    cells_list (list): List of uint64 arrays of h3 cells
+    sums_list (list): List of float arrays with the population summed in each of those cells
+
+    Returns:
+    tuple: Sorted array of distinct h3 cells and the total population of each cell
+    """
+    cells, inverse = np.unique(np.concatenate(cells_list), return_inverse=True)
+    sums = np.bincount(inverse, weights=np.concatenate(sums_list), minlength=cells.size)
+    return cells, sums
+
+def aggregate_tif_windowed(filename, population_column_name, resolution=H3_RESOLUTION,
+                           subsamples=PIXEL_SUBSAMPLES, compact_threshold=STREAMING_COMPACT_THRESHOLD):
+    """
+    Aggregates a raster into h3 cells by streaming it block window by block window.
+
+    Every window is reduced straight into per-cell partial sums, which are merged whenever
+    more than compact_threshold partial entries are pending. The peak memory is bounded by
+    the size of a window plus the number of distinct cells, not by the pixel count.
+
+    Parameters:
+    filename (str): Path to the raster file
+    population_column_name (str): Name of the output population column
+    resolution (int): h3 resolution of the cells
+    subsamples (int): Number of samples per pixel side used to apportion the pixels to the cells
+    compact_threshold (int): Number of pending partial entries triggering a merge
+
+    Returns:
+    pandas.DataFrame: DataFrame with the h3 cells and the population summed in each cell
+    """
+    print(f'Streaming {filename} by block windows for {population_column_name}')
+    cells_list = []
+    sums_list = []
+    pending = 0
+    with rasterio.open(filename) as src:
+        nodata = src.nodata
+        for _, window in src.block_windows(1):
+            band = src.read(1, window=window)
+            valid = get_valid_pixels_mask(band, nodata)
+            if not valid.any():
+                continue
+            rows, cols = np.nonzero(valid)
+            lon, lat = get_subpixel_centers(src.window_transform(window), rows, cols, subsamples)
+            window_cells, inverse = np.unique(geo_to_h3_array(lat, lon, resolution), return_inverse=True)
+            sample_values = np.repeat(band[valid].astype(np.float64), subsamples ** 2) / subsamples ** 2
+            cells_list.append(window_cells)
+            sums_list.append(np.bincount(inverse, weights=sample_values, minlength=window_cells.size))
+            pending += window_cells.size
+
+            if pending > compact_threshold:
+                cells, sums = merge_partial_sums(cells_list, sums_list)
+                cells_list, sums_list = [cells], [sums]
+                pending = cells.size
+
+    if not cells_list:
+        return pd.DataFrame({'h3': pd.Series(dtype=np.uint64), population_column_name: pd.Series(dtype=np.float64)})
+
+    cells, sums = merge_partial_sums(cells_list, sums_list)
+    return pd.DataFrame({
+        'h3': cells,
+        population_column_name: sums
+    })
+
+def get_grid_index(transform, shape):
+    """Returns the grid index of the process, only loading or building it again for a different grid."""
+    global _grid_index
+    if _grid_index is None or not _grid_index.matches(transform, shape):
+        _grid_index = GridIndex.load_or_build(transform, shape)
+    return _grid_index
+
+def get_file_content_hash(filepath, chunk_size=1 << 20):
+    """Returns the sha256 hex digest of the content of a file, read in chunks."""
+    file_hash = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def get_band_cache_path(filepath, streaming):
+    """
+    Returns the path (without extension) of the cached h3 aggregate of a raster, keyed on the
+    content hash of the file and on every parameter changing the aggregate.
+    """
+    parameters = f'{H3_RESOLUTION}|{PIXEL_SUBSAMPLES}|{NODATA_HANDLING}|{"windowed" if streaming else "grid_index"}'
+    key = hashlib.sha256(f'{get_file_content_hash(filepath)}|{parameters}'.encode()).hexdigest()[:32]
+    return os.path.join(BUILD_CACHE_DIR, f'agesex_{key}')
+
+def load_cached_band(cache_path, population_column_name):
+    """Loads a cached h3 aggregate, returning None if it is missing or unreadable."""
+    if not os.path.exists(f'{cache_path}.feather'):
+        return None
+    try:
+        df_h3 = load_intermediate(f'{cache_path}.feather').to_pandas()
+    except Exception as e:
+        print(f'[WARNING] Could not read the cached aggregate {cache_path}.feather: {str(e)}')
+        return None
+    return df_h3.rename(columns={'population': population_column_name})
+
+def find_cached_band(filename, file_feature, streaming):
+    """
+    Looks up the cached h3 aggregate of a raster.
+
+    Returns:
+    tuple: Cache path of the aggregate, and the cached aggregate (None if it must be recomputed)
+    """
+    cache_path = get_band_cache_path(os.path.join(RAW_DATA_DIR, AGE_DEMOGRAPHICS_DIR, filename), streaming)
+    df_h3 = load_cached_band(cache_path, f'population_{file_feature}')
+    if df_h3 is not None:
+        print(f'[INFO] {filename} is unchanged, reusing the cached aggregate {cache_path}.feather')
+    return cache_path, df_h3
+
+def store_cached_band(df_h3, cache_path, population_column_name):
+    """Stores the h3 aggregate of a raster in the build cache."""
+    save_intermediate(df_h3.rename(columns={population_column_name: 'population'}), cache_path)
+
+def process_age_sex_file(filename, file_feature, streaming=False, save_intermediates=SAVE_INTERMEDIATES,
+                         use_build_cache=USE_BUILD_CACHE):
+    """
+    Aggregates a single age/sex raster into a DataFrame of h3 cells.
+
+    Parameters:
+    filename (str): Name of the raster file in the age/sex directory
+    file_feature (str): Feature encoded in the file name (e.g. 'f0')
+    streaming (bool): Whether to stream the raster by block windows
+    save_intermediates (bool): Whether to save the per-pixel and per-cell dataframes for debugging
+    use_build_cache (bool): Whether to reuse (and store) the aggregate cached for the same file content
+
+    Returns:
+    pandas.DataFrame: DataFrame with the h3 cells and the population summed in each cell
+    """
+    print(f'Processing file: {filename}')
+    filepath = os.path.join(RAW_DATA_DIR, AGE_DEMOGRAPHICS_DIR, filename)
+    population_column_name = f'population_{file_feature}'
+    if use_build_cache:
+        cache_path, df_h3 = find_cached_band(filename, file_feature, streaming)
+        if df_h3 is not None:
+            return df_h3
+
+    if streaming:
+        # The band is never loaded in full, so there is no per-pixel dataframe to save
+        df_h3 = aggregate_tif_windowed(filepath, population_column_name)
+    else:
+        band1, transform, nodata = read_tif_band(filepath)
+        if save_intermediates:
+            # The per-pixel dataframe is only needed for debugging
+            df_file = band_to_df(band1, transform, nodata, file_feature)
             print(f'Successfully created a df from file: {filename}')
-            print(f'Columns of the resulting df: {df_file.columns}')
-            print(f'{filename} df info:\n')
             print(df_file.head(5))
-            print(f'Saving dataframe from file {filename}')
-            save_dataframe_to_csv(df_file, f'../output/df_tif_files/df_KEN_agesex_{file_names_dict[filename]}.csv')
-            print(f'Successfully saved tif dataframe as csv')
-            df_h3 = gis_df_to_h3_df(df_file, df_file.columns[0])
-            print(f'Saving H3 dataframe for {df_file.columns[0]}')
-            save_dataframe_to_csv(df_file, f'../output/df_h3/df_KEN_agesex_{df_file.columns[0]}.csv')
-            print(f'Successfully saved H3 dataframe as csv')
-            df_list.append(df_h3)
-        except:
-            print(f"An error has occured while processing the file: {filename}")
-    
-    return df_list
+            save_intermediate(df_file, f'../output/df_tif_files/df_KEN_agesex_{file_feature}')
+
+        # The h3 mapping of the grid is only computed again if the file uses a different grid
+        grid_index = get_grid_index(transform, band1.shape)
+        print(f'Processing df for {population_column_name}')
+        df_h3 = grid_index.aggregate_band(band1, nodata, population_column_name)
+
+    if save_intermediates:
+        save_intermediate(df_h3, f'../output/df_h3/df_KEN_agesex_{population_column_name}')
+    if use_build_cache:
+        store_cached_band(df_h3, cache_path, population_column_name)
+    return df_h3
+
+def prepare_grid_index(file_names_dict):
+    """Builds (or loads) the grid index of the first raster so that worker processes find it in the cache."""
+    filename = next(iter(file_names_dict))
+    with rasterio.open(os.path.join(RAW_DATA_DIR, AGE_DEMOGRAPHICS_DIR, filename)) as src:
+        get_grid_index(src.transform, src.shape)
+
+def create_df_list_from_directory(file_names_dict, streaming=STREAMING, workers=WORKERS, save_intermediates=SAVE_INTERMEDIATES,
+                                  use_build_cache=USE_BUILD_CACHE):
+    """
+    Aggregates every age/sex raster of the directory into a DataFrame of h3 cells.
+
+    Parameters:
+    file_names_dict (dict): Dictionary with file names as keys and features as values
+    streaming (bool): Whether to stream the rasters by block windows
+    workers (int): Number of worker processes, None to use all the cores
+    save_intermediates (bool): Whether to save the per-pixel and per-cell dataframes for debugging
+    use_build_cache (bool): Whether to only recompute the bands whose file content or parameters changed
+
+    Returns:
+    list: List of DataFrames, in the order of file_names_dict regardless of completion order
+
+    Raises:
+    RuntimeError: If any file could not be processed, after all the files have been attempted
+    """
+    results = {}
+    errors = {}
+    if workers is None:
+        workers = os.cpu_count()
+
+    if workers == 1 or len(file_names_dict) <= 1:
+        for filename, file_feature in file_names_dict.items():
+            try:
+                results[filename] = process_age_sex_file(filename, file_feature, streaming, save_intermediates,
+                                                         use_build_cache)
+            except Exception as e:
+                errors[filename] = f'{type(e).__name__}: {str(e)}\n{traceback.format_exc()}'
+                print(f"[ERROR] An error has occured while processing the file: {filename}\n{errors[filename]}")
+    else:
+        # The cache hits are resolved before starting the workers, so that the grid index is only
+        # prepared (and the workers only started) if some file actually needs to be recomputed
+        pending = {}
+        for filename, file_feature in file_names_dict.items():
+            cache_path = None
+            if use_build_cache:
+                try:
+                    cache_path, df_h3 = find_cached_band(filename, file_feature, streaming)
+                except Exception as e:
+                    errors[filename] = f'{type(e).__name__}: {str(e)}'
+                    print(f"[ERROR] An error has occured while processing the file: {filename}\n{errors[filename]}")
+                    continue
+                if df_h3 is not None:
+                    results[filename] = df_h3
+                    continue
+            pending[filename] = (file_feature, cache_path)
+
+        if pending and not streaming:
+            try:
+                prepare_grid_index(pending)
+            except Exception as e:
+                # The failing file is reported again with the others once processed by the workers
+                print(f'[WARNING] Could not prepare the grid index before starting the workers: {str(e)}')
+        if pending:
+            print(f'[INFO] Processing {len(pending)} files with {workers} worker processes...')
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                # The cache was already looked up, so the workers only aggregate and the results are
+                # stored in the cache here
+                futures = {
+                    executor.submit(process_age_sex_file, filename, file_feature, streaming, save_intermediates,
+                                    False): filename
+                    for filename, (file_feature, _) in pending.items()
+                }
+                for future in as_completed(futures):
+                    filename = futures[future]
+                    file_feature, cache_path = pending[filename]
+                    try:
+                        results[filename] = future.result()
+                        if cache_path is not None:
+                            store_cached_band(results[filename], cache_path, f'population_{file_feature}')
+                        print(f'[INFO] Finished processing {filename}')
+                    except Exception as e:
+                        errors[filename] = f'{type(e).__name__}: {str(e)}'
+                        print(f"[ERROR] An error has occured while processing the file: {filename}\n{errors[filename]}")
+
+    raise_on_failures(errors, len(file_names_dict), 'age/sex files')
+
+    # Merge the results in a deterministic order, independent of the completion order of the workers
+    return [results[filename] for filename in file_names_dict]
 
 def join_dataframes_on_h3(dataframe_list):
     """
     Join multiple DataFrames based on the 'h3' column.
+
+    Instead of chaining outer merges, the union of all the h3 cells is sorted once and every
+    column is written at its position in a preallocated float32 matrix (cells x columns).
+    Cells missing from a DataFrame are left as NaN, as with an outer join.
     
     Parameters:
     dataframe_list (list): List of pandas DataFrames to join
@@ -125,14 +573,20 @@ def join_dataframes_on_h3(dataframe_list):
     # Check if the list is empty
     if not dataframe_list:
         return pd.DataFrame()
-    
-    # Function to perform the join
-    def join_two_dataframes(left, right):
-        return pd.merge(left, right, on='h3', how='outer')
-    
-    # Use reduce to apply the join function to all DataFrames in the list
-    joined_df = reduce(join_two_dataframes, dataframe_list)
-    
+
+    value_columns = [column for df in dataframe_list for column in df.columns if column != 'h3']
+    cells = np.unique(np.concatenate([df['h3'].to_numpy() for df in dataframe_list]))
+    matrix = np.full((cells.size, len(value_columns)), np.nan, dtype=np.float32)
+
+    column_position = 0
+    for df in dataframe_list:
+        positions = np.searchsorted(cells, df['h3'].to_numpy())
+        for column in df.columns.drop('h3'):
+            matrix[positions, column_position] = df[column].to_numpy()
+            column_position += 1
+
+    joined_df = pd.DataFrame(matrix, columns=value_columns)
+    joined_df.insert(0, 'h3', cells)
     return joined_df
 
 def save_dataframe_to_csv(dataframe, filepath):
@@ -152,18 +606,81 @@ def save_dataframe_to_csv(dataframe, filepath):
     except Exception as e:
         print(f"An error occurred while saving the DataFrame: {str(e)}")
 
-def create_agregate_df_age_sex():
+def save_intermediate(dataframe, filepath, file_format=INTERMEDIATE_FORMAT, compression=INTERMEDIATE_COMPRESSION):
+    """
+    Save an intermediate DataFrame in a compressed columnar binary format.
+
+    Parameters:
+    dataframe (pandas.DataFrame): DataFrame to save
+    filepath (str): Path where the file should be saved, without the extension
+    file_format (str): Either 'feather' or 'parquet'
+    compression (str): Compression codec ('zstd', 'lz4' or 'uncompressed')
+
+    Returns:
+    str: Path of the saved file
+    """
+    filepath = f'{filepath}.{file_format}'
+    try:
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        table = pa.Table.from_pandas(dataframe, preserve_index=False)
+        if file_format == 'feather':
+            feather.write_feather(table, filepath, compression=compression)
+        elif file_format == 'parquet':
+            pq.write_table(table, filepath, compression=None if compression == 'uncompressed' else compression)
+        else:
+            raise ValueError(f'Unsupported intermediate format: {file_format}')
+        print(f"DataFrame successfully saved to {filepath}")
+    except Exception as e:
+        print(f"An error occurred while saving the DataFrame: {str(e)}")
+    return filepath
+
+def load_intermediate(filepath, columns=None):
+    """
+    Load an intermediate file saved by save_intermediate as a memory-mapped pyarrow Table.
+
+    The columns of uncompressed feather files are read without copying; use
+    Table.column(name) for zero-copy access or Table.to_pandas() to get a DataFrame.
+
+    Parameters:
+    filepath (str): Path to the .feather or .parquet file
+    columns (list): Optional list of columns to read
+
+    Returns:
+    pyarrow.Table: Table with the requested columns
+    """
+    if filepath.endswith('.parquet'):
+        return pq.read_table(filepath, columns=columns, memory_map=True)
+    return feather.read_table(filepath, columns=columns, memory_map=True)
+
+def create_agregate_df_age_sex(streaming=STREAMING, workers=WORKERS, save_intermediates=SAVE_INTERMEDIATES,
+                               use_build_cache=USE_BUILD_CACHE):
+    """
+    Aggregates all the age/sex rasters into a single DataFrame of h3 cells.
+
+    Parameters:
+    streaming (bool): Whether to stream the rasters by block windows (bounded memory) instead
+        of reading whole bands and using the cached grid index
+    workers (int): Number of worker processes processing the files in parallel, None to use all the cores
+    save_intermediates (bool): Whether to save the per-pixel and per-cell dataframes of every band
+    use_build_cache (bool): Whether to only recompute the bands whose file content or parameters changed
+
+    Returns:
+    pandas.DataFrame: DataFrame with one row per h3 cell and one column per age/sex band
+    """
     data_dir = os.path.join(RAW_DATA_DIR, AGE_DEMOGRAPHICS_DIR)
     file_names = get_file_names(data_dir)
     file_names_dict = filter_files(file_names=file_names)
-    df_h3_list = create_df_list_from_directory(file_names_dict)
+    df_h3_list = create_df_list_from_directory(file_names_dict, streaming=streaming, workers=workers,
+                                              save_intermediates=save_intermediates, use_build_cache=use_build_cache)
     df_age_sex_aggr = join_dataframes_on_h3(df_h3_list)
     return df_age_sex_aggr
 
 
-def main():
-    df_age_sex_aggr = create_agregate_df_age_sex()
+def main(streaming=STREAMING, workers=WORKERS):
+    df_age_sex_aggr = create_agregate_df_age_sex(streaming=streaming, workers=workers)
     output_path = os.path.join(PROCESSED_DATA_DIR, 'KEN_agesex_aggregated.csv')
+    if EXPORT_H3_AS_STRING:
+        df_age_sex_aggr = h3_column_to_str(df_age_sex_aggr)
     save_dataframe_to_csv(df_age_sex_aggr, output_path)
 
 if __name__ == "__main__":
@@ -10,8 +10,16 @@ and age demographics to produce a dataset with h3 hexagons that contain a lot of
 import geopandas as gpd 
 import pandas as pd
 import os
+import numpy as np
+import shutil
 import h3
-from shapely.geometry import Point
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from h3.api import basic_int as h3_int
+from shapely.geometry import mapping
+from shapely import STRtree
+from h3_utils import H3_RESOLUTION, h3_to_int_array, h3_to_geo_array, h3_int_to_str_array, h3_to_parent_array, find_in_sorted, raise_on_failures, EXPORT_H3_AS_STRING
 
 RAW_DATA_DIR = '../../data/raw'
 PROCESSED_DATA_DIR = '../../data/processed'
@@ -19,14 +27,15 @@ PROCESSED_DATA_DIR = '../../data/processed'
 # Directory where the shape files for the different administration levels in kenya are saved
 ADM_SHP_DIR = 'ken_adm_iebc_20191031_shp'
 
-def load_ken_counties_shp_file():
-    print('[INFO] Attempting to load the county shape file...')
-    file_name = 'ken_admbnda_adm1_iebc_20191031.shp'
-    file_path = os.path.join(RAW_DATA_DIR, ADM_SHP_DIR, file_name)
-    counties = gpd.read_file(file_path)
-    print('f[INFO] File found at {file_path}')
-    print('f[INFO] Counties shapes loaded successfully!\n')
-    return counties
+# Projected CRS in which the distances to the nearest admin unit are measured for the hexagons
+# matching no admin polygon (e.g. 'EPSG:21037'), None to measure them in degrees
+NEAREST_METRIC_CRS = None
+
+# Coarse h3 resolution of the shards processed by the workers in the partitioned build
+PARTITION_RESOLUTION = 3
+
+# Directory of the partitioned dataset, with one 'partition=<h3 parent>' directory per shard
+PARTITIONED_OUTPUT_DIR = os.path.join(PROCESSED_DATA_DIR, 'KEN_h3_data_full_partitioned')
 
 def load_ken_sub_counties_shp_file():
     print('[INFO] Attempting to load the sub-county shape file...')
@@ -56,112 +65,362 @@ def load_ken_highest_crimes_subcounties():
     crimes_df = crimes_df.rename(columns={'Subnational region': 'county'})
     return crimes_df
 
-def get_county_from_coordinates(df, counties):
-    geometry = [Point(xy) for xy in zip(df['longitude'], df['latitude'])]
-    h3_gdf = gpd.GeoDataFrame(df, geometry=geometry, crs='EPSG:4326')
+def get_nearest_admin_positions(points, admin_gdf, metric_crs=NEAREST_METRIC_CRS):
+    """
+    Find the nearest admin unit of every point with a single query on an STRtree built over
+    the admin geometries, instead of computing the distance to every polygon row by row.
 
-    # Perform spatial join
-    # This will add all columns from counties to the H3 data
-    result = gpd.sjoin(h3_gdf, counties, how='left', predicate='within')
+    Parameters:
+    points (GeoSeries): Points to assign, in EPSG:4326
+    admin_gdf (GeoDataFrame): Admin boundaries, in EPSG:4326
+    metric_crs (str): Optional projected CRS in which the distances are measured
 
-    df['county'] = result['ADM1_EN']
+    Returns:
+    numpy.ndarray: Row position in admin_gdf of the nearest admin unit of every point
+    """
+    admin_geometries = admin_gdf.geometry
+    if metric_crs is not None:
+        points = points.to_crs(metric_crs)
+        admin_geometries = admin_geometries.to_crs(metric_crs)
 
-    # Some hexagons are left unmatched so perform other operations to match them with a county
-    unmatched_hexagons = df[df['county'].isna()].copy()
-    geometry = [Point(xy) for xy in zip(unmatched_hexagons['longitude'], unmatched_hexagons['latitude'])]
-    h3_gdf = gpd.GeoDataFrame(unmatched_hexagons, geometry=geometry, crs='EPSG:4326')
-    intersect_match = gpd.sjoin(h3_gdf, counties, how='left', predicate='intersects')
+    tree = STRtree(admin_geometries.values)
+    point_positions, admin_positions = tree.query_nearest(points.values, all_matches=False)
+    nearest = np.empty(len(points), dtype=np.intp)
+    nearest[point_positions] = admin_positions
+    return nearest
 
+def get_admin_units_from_coordinates(df, sub_counties):
+    """
+    Assign the sub-county of every hexagon center with a single spatial join, and derive the
+    county from the ADM1 unit the sub-county belongs to (every sub-county nests in one county).
+    Centers falling in no sub-county are assigned the nearest one.
 
-    def assign_nearest_county(point, counties_gdf):
-        # Calculate distance to all counties
-        distances = counties_gdf.geometry.distance(point.geometry)
-        # Get the county with minimum distance
-        nearest_county = counties_gdf.iloc[distances.argmin()]
-        return nearest_county['ADM1_EN']
+    Parameters:
+    df (pandas.DataFrame): h3 data with 'latitude' and 'longitude' columns
+    sub_counties (GeoDataFrame): Sub-county boundaries with the 'ADM1_EN' and 'ADM2_EN' columns
 
-    # For any hexagons still unmatched after intersects, find nearest county
-    still_unmatched = intersect_match[intersect_match['ADM1_EN'].isna()]
-    if len(still_unmatched) > 0:
-        still_unmatched['nearest_county'] = still_unmatched.apply(
-            lambda x: assign_nearest_county(x, counties), axis=1
-        )
+    Returns:
+    tuple: Series of county names and Series of sub-county names, indexed like df
+    """
+    # Only the points are wrapped in a GeoDataFrame, the columns of the h3 data are not copied
+    points = gpd.GeoSeries(gpd.points_from_xy(df['longitude'], df['latitude']), crs='EPSG:4326')
+    admin_units = sub_counties[['ADM1_EN', 'ADM2_EN', 'geometry']].reset_index(drop=True)
+    matches = gpd.sjoin(gpd.GeoDataFrame(geometry=points), admin_units, how='left', predicate='intersects')
 
-    df.loc[still_unmatched.index, 'county'] = still_unmatched['nearest_county']
-    return df
+    # Keep the first sub-county of the points on a boundary between two of them
+    matches = matches[~matches.index.duplicated()]
+    admin_positions = matches['index_right'].to_numpy(dtype=float)
+    unmatched = np.isnan(admin_positions)
+    print(f"Number of unmatched hexagons = {unmatched.sum()}")
+    if unmatched.any():
+        admin_positions[unmatched] = get_nearest_admin_positions(points[unmatched], admin_units)
+    admin_positions = admin_positions.astype(np.intp)
+
+    county = pd.Series(admin_units['ADM1_EN'].to_numpy()[admin_positions], index=df.index, dtype=object)
+    sub_county = pd.Series(admin_units['ADM2_EN'].to_numpy()[admin_positions], index=df.index, dtype=object)
+    return county, sub_county
+
+def polyfill_admin_units(admin_gdf, name_column, names, resolution=H3_RESOLUTION):
+    """
+    Polyfill every admin polygon into the h3 cells whose centers fall inside it.
+
+    Parameters:
+    admin_gdf (GeoDataFrame): Admin boundaries in EPSG:4326
+    name_column (str): Column holding the name of the admin units
+    names (numpy.ndarray): Sorted names of the admin units, whose positions are used as ids
+    resolution (int): h3 resolution of the cells
+
+    Returns:
+    tuple: uint64 array of cells and int16 array with the id of the admin unit of every cell
+    """
+    cells_list = []
+    ids_list = []
+    for name, geometry in zip(admin_gdf[name_column], admin_gdf.geometry):
+        polygons = geometry.geoms if geometry.geom_type == 'MultiPolygon' else [geometry]
+        unit_cells = set()
+        for polygon in polygons:
+            unit_cells |= h3_int.polyfill(mapping(polygon), resolution, geo_json_conformant=True)
+        cells_list.append(np.fromiter(unit_cells, dtype=np.uint64, count=len(unit_cells)))
+        ids_list.append(np.full(len(unit_cells), np.searchsorted(names, name), dtype=np.int16))
+    return np.concatenate(cells_list), np.concatenate(ids_list)
+
+def get_admin_lookup_source_key(resolution):
+    """Key identifying the shapefile and resolution an admin lookup was built from."""
+    file_name = 'ken_admbnda_adm2_iebc_20191031.shp'
+    file_stat = os.stat(os.path.join(RAW_DATA_DIR, ADM_SHP_DIR, file_name))
+    return f'{resolution}|{file_name}:{file_stat.st_size}:{int(file_stat.st_mtime)}'
+
+def build_admin_lookup(sub_counties, resolution=H3_RESOLUTION):
+    """
+    Build the lookup table from h3 cells to the county and sub-county they belong to.
+
+    Every sub-county polygon is polyfilled into h3 cells, and the county of every cell is
+    derived from the ADM1 unit of its sub-county. The cells left without a sub-county (cells
+    straddling a boundary between two units, and the ring of cells just outside the country
+    boundary) are then resolved once with the spatial join.
+
+    Returns:
+    dict: Sorted uint64 'cells' with their int16 'county_id' and 'sub_county_id' (-1 when
+        unknown), and the 'county_names' and 'sub_county_names' the ids refer to
+    """
+    print('[INFO] Building the h3 to admin units lookup table...')
+    county_names = np.array(sorted(sub_counties['ADM1_EN'].dropna().unique()))
+    sub_county_names = np.array(sorted(sub_counties['ADM2_EN'].dropna().unique()))
+    sub_county_cells, sub_county_ids = polyfill_admin_units(sub_counties, 'ADM2_EN', sub_county_names, resolution)
 
-def get_subcounty_from_coordinates(df, sub_counties):
-    geometry = [Point(xy) for xy in zip(df['longitude'], df['latitude'])]
-    h3_gdf = gpd.GeoDataFrame(df, geometry=geometry, crs='EPSG:4326')
-
-    # Perform spatial join
-    # This will add all columns from sub-counties to H3 data
-    result = gpd.sjoin(h3_gdf, sub_counties, how='left', predicate='within')
-
-   
-    original_columns = list(df.columns)
-    df['sub_county'] = result['ADM2_EN']
-
-    # Some hexagons are left unmatched so perform other operations to match them with a county
-    unmatched_hexagons = df[df['sub_county'].isna()].copy()
-    geometry = [Point(xy) for xy in zip(unmatched_hexagons['longitude'], unmatched_hexagons['latitude'])]
-    h3_gdf = gpd.GeoDataFrame(unmatched_hexagons, geometry=geometry, crs='EPSG:4326')
-    intersect_match = gpd.sjoin(h3_gdf, sub_counties, how='left', predicate='intersects')
-
-    print(f"Number of unmatched hexagons = {len(unmatched_hexagons)}")
-    print(f"Number of intersect matches = {len(intersect_match)}")
-    
-    def assign_nearest_sub_county(point, sub_counties_gdf):
-        # Calculate distance to all sub-counties
-        distances = sub_counties_gdf.geometry.distance(point.geometry)
-        # Get the sub-county with minimum distance
-        nearest_county = sub_counties_gdf.iloc[distances.argmin()]
-        return nearest_county['ADM2_EN']
-
-    # For any hexagons still unmatched after intersects, find nearest county
-    still_unmatched = intersect_match[intersect_match['sub_county'].isna()]
-    if len(still_unmatched) > 0:
-        still_unmatched['nearest_sub_county'] = still_unmatched.apply(
-            lambda x: assign_nearest_sub_county(x, sub_counties), axis=1
-        )
-
-    df.loc[still_unmatched.index, 'sub_county'] = still_unmatched['nearest_sub_county']
+    # County id of every sub-county id
+    parent_ids = np.full(sub_county_names.size, -1, dtype=np.int16)
+    parent_ids[np.searchsorted(sub_county_names, sub_counties['ADM2_EN'].to_numpy(dtype=str))] = np.searchsorted(
+        county_names, sub_counties['ADM1_EN'].to_numpy(dtype=str)
+    )
+
+    # Add the ring of cells around the filled cells, so that boundary cells are resolved too
+    filled_cells = np.unique(sub_county_cells)
+    ring_cells = set()
+    for cell in filled_cells.tolist():
+        ring_cells |= h3_int.k_ring(cell, 1)
+    cells = np.union1d(filled_cells, np.fromiter(ring_cells, dtype=np.uint64, count=len(ring_cells)))
+
+    lookup = {
+        'cells': cells,
+        'county_id': np.full(cells.size, -1, dtype=np.int16),
+        'sub_county_id': np.full(cells.size, -1, dtype=np.int16),
+        'county_names': county_names,
+        'sub_county_names': sub_county_names,
+    }
+    lookup['sub_county_id'][np.searchsorted(cells, sub_county_cells)] = sub_county_ids
+
+    # Resolve the cells missing a sub-county from their centers
+    unresolved = lookup['sub_county_id'] < 0
+    print(f'[INFO] Resolving {unresolved.sum()} boundary cells out of {cells.size}...')
+    if unresolved.any():
+        latitudes, longitudes = h3_to_geo_array(cells[unresolved])
+        boundary_df = pd.DataFrame({'latitude': latitudes, 'longitude': longitudes})
+        _, boundary_sub_counties = get_admin_units_from_coordinates(boundary_df, sub_counties)
+        lookup['sub_county_id'][unresolved] = np.searchsorted(sub_county_names, boundary_sub_counties.to_numpy(dtype=str))
+    lookup['county_id'] = parent_ids[lookup['sub_county_id']]
+    print('[INFO] Lookup table built!\n')
+    return lookup
+
+def load_or_build_admin_lookup(sub_counties, resolution=H3_RESOLUTION):
+    """Loads the admin lookup table if it was built from the same shapefile, otherwise builds and saves it."""
+    file_path = os.path.join(PROCESSED_DATA_DIR, f'KEN_h3_admin_lookup_res{resolution}.npz')
+    source_key = get_admin_lookup_source_key(resolution)
+    if os.path.exists(file_path):
+        with np.load(file_path) as cached:
+            if str(cached['source_key']) == source_key:
+                print(f'[INFO] Admin lookup table loaded from {file_path}\n')
+                return {key: cached[key] for key in cached.files if key != 'source_key'}
+
+    lookup = build_admin_lookup(sub_counties, resolution)
+    try:
+        np.savez(file_path, source_key=source_key, **lookup)
+        print(f'[INFO] Admin lookup table saved to {file_path}\n')
+    except Exception as e:
+        print(f"An error occurred while saving the admin lookup table: {str(e)}")
+    return lookup
+
+def get_admin_units_from_lookup(df, lookup, sub_counties):
+    """
+    Add the county and sub_county columns to the h3 data in place, with an array lookup of
+    every cell in the admin lookup table. Cells missing from the table fall back to the
+    spatial join.
+
+    Parameters:
+    df (pandas.DataFrame): h3 data with uint64 'h3', 'latitude' and 'longitude' columns
+    lookup (dict): Lookup table returned by load_or_build_admin_lookup
+    sub_counties (GeoDataFrame): Sub-county boundaries, only used for the fallback
+
+    Returns:
+    pandas.DataFrame: h3 data with the county and sub_county columns
+    """
+    cells = df['h3'].to_numpy(dtype=np.uint64)
+    positions, found = find_in_sorted(cells, lookup['cells'])
+    # The table is only indexed at the found positions, as it is empty for the shards of the
+    # partitioned build whose cells are all outside of it
+    sub_county_ids = np.full(cells.size, -1, dtype=np.int16)
+    sub_county_ids[found] = lookup['sub_county_id'][positions[found]]
+    county_ids = np.full(cells.size, -1, dtype=np.int16)
+    county_ids[found] = lookup['county_id'][positions[found]]
+    county_ids[sub_county_ids < 0] = -1
+
+    df['county'] = pd.Series(lookup['county_names'][np.maximum(county_ids, 0)], index=df.index, dtype=object).where(county_ids >= 0)
+    df['sub_county'] = pd.Series(lookup['sub_county_names'][np.maximum(sub_county_ids, 0)], index=df.index, dtype=object).where(sub_county_ids >= 0)
+
+    unresolved = sub_county_ids < 0
+    if unresolved.any():
+        print(f'[INFO] {unresolved.sum()} hexagons are not in the admin lookup table, using the spatial join for them')
+        county, sub_county = get_admin_units_from_coordinates(df.loc[unresolved, ['latitude', 'longitude']], sub_counties)
+        df.loc[unresolved, 'county'] = county
+        df.loc[unresolved, 'sub_county'] = sub_county
     return df
 
-def main():
-    counties = load_ken_counties_shp_file()
-    sub_counties = load_ken_sub_counties_shp_file()
+def enrich_h3_data(h3_data, admin_lookup, sub_counties, poverty_df, high_crime_sub_counties):
+    """
+    Add the admin units, poverty and crime columns to the h3 data in place.
 
-    # Load the h3 data with age_demographics and population data
-    h3_data_file_path = os.path.join(PROCESSED_DATA_DIR, 'KEN_population_age_demographics_merged.csv')
-    h3_data = pd.read_csv(h3_data_file_path)
+    Parameters:
+    h3_data (pandas.DataFrame): h3 data with uint64 'h3', 'latitude' and 'longitude' columns
+    admin_lookup (dict): Lookup table returned by load_or_build_admin_lookup
+    sub_counties (GeoDataFrame): Sub-county boundaries, only used for the cells missing from the lookup
+    poverty_df (pandas.DataFrame): Poverty data indexed by county
+    high_crime_sub_counties (array-like): Stripped, lowercased names of the high crime sub-counties
 
+    Returns:
+    pandas.DataFrame: The augmented h3 data
+    """
     # Augment h3 data with the names of counties and subcounties they belong to
-    h3_df_county = get_county_from_coordinates(h3_data.copy(), counties.copy())
-    h3_df_all_adm = get_subcounty_from_coordinates(h3_df_county.copy(), sub_counties.copy())
+    get_admin_units_from_lookup(h3_data, admin_lookup, sub_counties)
 
     # Augment h3 data with poverty data (MPI)
-    poverty_df = load_process_ken_poverty_data()
-    h3_with_poverty = h3_df_all_adm.merge(poverty_df, on='county', how='left')
+    # The columns are mapped from the county in place instead of merging into a new table
+    for column in poverty_df.columns:
+        h3_data[column] = h3_data['county'].map(poverty_df[column])
 
     # Augment h3 data with crimes for subcounties by creating a new boolean column 
     # Column is set to 1 if the subcounty the h3 hexagon belongs to figure in the crimes 
+    h3_data['sub_county'] = h3_data['sub_county'].str.strip().str.lower()
+    h3_data['high_crime_in_county'] = 0
+    h3_data.loc[h3_data['sub_county'].isin(high_crime_sub_counties), 'high_crime_in_county'] = 1
+    return h3_data
+
+def get_partition_sub_counties(sub_counties, in_lookup):
+    """
+    Select the sub-counties a shard needs. They are only used for the cells missing from the admin
+    lookup table, so a shard whose cells are all in the table gets none of them. Any other shard
+    gets all of them rather than the ones around the shard, so that the nearest sub-county of a
+    cell outside every boundary is the same as in the single-process build.
+    """
+    if in_lookup.all():
+        return sub_counties.iloc[:0]
+    return sub_counties
+
+def get_partition_admin_lookup(admin_lookup, positions):
+    """Returns the entries of the admin lookup table at the given sorted positions only."""
+    return {
+        key: values[positions] if key in ('cells', 'county_id', 'sub_county_id') else values
+        for key, values in admin_lookup.items()
+    }
+
+def get_partition_path(output_dir, partition):
+    """Path of the parquet file of a shard in the partitioned dataset."""
+    return os.path.join(output_dir, f'partition={format(partition, "x")}', 'part-0.parquet')
+
+def enrich_partition(partition, shard, admin_lookup, sub_counties, poverty_df, high_crime_sub_counties,
+                     output_dir=PARTITIONED_OUTPUT_DIR):
+    """
+    Enrich one shard of the h3 data and write it to its directory of the partitioned dataset.
+
+    Returns:
+    int: Number of rows written
+    """
+    enrich_h3_data(shard, admin_lookup, sub_counties, poverty_df, high_crime_sub_counties)
+    if EXPORT_H3_AS_STRING:
+        shard['h3'] = h3_int_to_str_array(shard['h3'].to_numpy())
+    file_path = get_partition_path(output_dir, partition)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    pq.write_table(pa.Table.from_pandas(shard, preserve_index=False), file_path)
+    return len(shard)
+
+def build_partitioned(h3_data, admin_lookup, sub_counties, poverty_df, high_crime_sub_counties, workers=None,
+                      partition_resolution=PARTITION_RESOLUTION, output_dir=PARTITIONED_OUTPUT_DIR):
+    """
+    Enrich the h3 data shard by shard in a process pool and write a partitioned parquet dataset.
+
+    The hexagons are sharded by their parent cell at partition_resolution. Every worker only
+    receives the rows of its shard and the entries of the admin lookup table for these cells,
+    which keeps the memory of the workers small. The sub-county boundaries are only sent with the
+    shards having cells missing from the table, see get_partition_sub_counties.
+
+    Parameters:
+    h3_data (pandas.DataFrame): h3 data with uint64 'h3', 'latitude' and 'longitude' columns
+    workers (int): Number of worker processes, None to use all the cores
+    partition_resolution (int): h3 resolution of the shards
+    output_dir (str): Directory of the partitioned dataset
+
+    Returns:
+    int: Number of rows written
+
+    Raises:
+    RuntimeError: If any shard could not be processed, after all the shards have been attempted
+    """
+    partitions = h3_to_parent_array(h3_data['h3'].to_numpy(dtype=np.uint64), partition_resolution)
+    shard_positions = pd.Series(np.arange(len(h3_data))).groupby(partitions).indices
+
+    # Positions of the cells in the admin lookup table, searched once and sliced for every shard
+    cells = h3_data['h3'].to_numpy(dtype=np.uint64)
+    lookup_positions, in_lookup = find_in_sorted(cells, admin_lookup['cells'])
+
+    # Remove the shards of a previous build, which may not exist anymore
+    if os.path.isdir(output_dir):
+        for entry in os.listdir(output_dir):
+            if entry.startswith('partition='):
+                shutil.rmtree(os.path.join(output_dir, entry))
+
+    if workers is None:
+        workers = os.cpu_count()
+    print(f'[INFO] Enriching {len(h3_data)} hexagons in {len(shard_positions)} shards with {workers} worker processes...')
+
+    rows = 0
+    errors = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for partition, positions in shard_positions.items():
+            shard = h3_data.iloc[positions].reset_index(drop=True)
+            shard_in_lookup = in_lookup[positions]
+            future = executor.submit(
+                enrich_partition, int(partition), shard,
+                get_partition_admin_lookup(admin_lookup, np.unique(lookup_positions[positions][shard_in_lookup])),
+                get_partition_sub_counties(sub_counties, shard_in_lookup),
+                poverty_df, high_crime_sub_counties, output_dir
+            )
+            futures[future] = format(int(partition), 'x')
+        for future in as_completed(futures):
+            partition = futures[future]
+            try:
+                rows += future.result()
+            except Exception as e:
+                errors[partition] = f'{type(e).__name__}: {str(e)}'
+                print(f"[ERROR] An error has occured while processing the shard: {partition}\n{errors[partition]}")
+
+    raise_on_failures(errors, len(shard_positions), 'shards')
+    return rows
+
+def main(partitioned=False, workers=None):
+    sub_counties = load_ken_sub_counties_shp_file()
+
+    # Load the h3 data with age_demographics and population data
+    h3_data_file_path = os.path.join(PROCESSED_DATA_DIR, 'KEN_population_age_demographics_merged.csv')
+    h3_data = pd.read_csv(h3_data_file_path)
+    h3_data['h3'] = h3_to_int_array(h3_data['h3'])
+    if 'latitude' not in h3_data.columns:
+        h3_data['latitude'], h3_data['longitude'] = h3_to_geo_array(h3_data['h3'].to_numpy())
+
+    # The county is derived from the sub-county, so only the sub-county boundaries are needed
+    # The lookup table is only built (with the spatial join) when the shapefile changes
+    admin_lookup = load_or_build_admin_lookup(sub_counties)
+    poverty_df = load_process_ken_poverty_data().drop_duplicates('county').set_index('county')
     crimes_sub_counties = load_ken_highest_crimes_subcounties()
-    h3_with_poverty['sub_county'] = h3_with_poverty['sub_county'].str.strip().str.lower()
-    crimes_sub_counties['sub-county'] = crimes_sub_counties['sub-county'].str.strip().str.lower()
+    high_crime_sub_counties = crimes_sub_counties['sub-county'].str.strip().str.lower().unique()
 
-    # Add the 'high_crime_in_county' column with default value of 0
-    h3_with_poverty['high_crime_in_county'] = 0
+    if partitioned:
+        try:
+            rows = build_partitioned(h3_data, admin_lookup, sub_counties, poverty_df, high_crime_sub_counties, workers)
+            print(f"[INFO] {rows} hexagons augmented with all data successfully saved to {PARTITIONED_OUTPUT_DIR}")
+        except Exception as e:
+            print(f"An error occurred while building the partitioned dataset: {str(e)}")
+        return
 
-    # Update 'high_crime_in_county' to 1 for matches in crimes subcounties data
-    h3_with_poverty.loc[h3_with_poverty['sub_county'].isin(crimes_sub_counties['sub-county']), 'high_crime_in_county'] = 1
+    enrich_h3_data(h3_data, admin_lookup, sub_counties, poverty_df, high_crime_sub_counties)
 
     try:
         export_filepath = os.path.join(PROCESSED_DATA_DIR, 'KEN_h3_data_full.csv')
-        h3_with_poverty.to_csv(export_filepath, index=False)
+        if EXPORT_H3_AS_STRING:
+            h3_data['h3'] = h3_int_to_str_array(h3_data['h3'].to_numpy())
+        h3_data.to_csv(export_filepath, index=False)
         print(f"[INFO] H3 data augmented with all data successfully saved to {export_filepath}")
     except Exception as e:
         print(f"An error occurred while saving the DataFrame: {str(e)}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,144 @@
+'''
+This script adds access features to the h3 hexagons, for site selection: the distance from the
+center of every hexagon to the nearest facility of each kind (hospital, school, bank, M-Pesa
+point...) and the number of these facilities within some radii. The facilities are read from
+the points exported by process_points_of_interest.py and process_financial_services_points.py.
+'''
+import pandas as pd
+import numpy as np
+import os
+from scipy.spatial import cKDTree
+from concurrent.futures import ProcessPoolExecutor
+from h3_utils import h3_to_geo_array, to_unit_vectors, chord_to_km, km_to_chord, replace_columns, update_h3_data_file
+
+PROCESSED_DATA_DIR = '../../data/processed'
+
+# Facilities the features are computed for: points file, and optionally the column and values
+# the points are filtered on (all the points of the file are used otherwise)
+FACILITY_TARGETS = {
+    'health_facility': {'file_name': 'KEN_health_facilities_points.csv'},
+    'hospital': {'file_name': 'KEN_health_facilities_points.csv', 'column': 'amenity', 'values': ['hospital']},
+    'pharmacy': {'file_name': 'KEN_health_facilities_points.csv', 'column': 'amenity', 'values': ['pharmacy']},
+    'educational_facility': {'file_name': 'KEN_educational_facilities_points.csv'},
+    'school': {'file_name': 'KEN_educational_facilities_points.csv', 'column': 'amenity', 'values': ['school']},
+    'transportation': {'file_name': 'KEN_transportation_points.csv'},
+    'bus_stop': {'file_name': 'KEN_transportation_points.csv', 'column': 'amenity', 'values': ['bus_stop', 'bus_station']},
+    'financial_service': {'file_name': 'KEN_financial_services_points.csv'},
+    'bank': {'file_name': 'KEN_financial_services_points.csv', 'column': 'amenity', 'values': ['bank']},
+    'atm': {'file_name': 'KEN_financial_services_points.csv', 'column': 'amenity', 'values': ['atm']},
+    'mpesa_point': {'file_name': 'KEN_financial_services_points.csv', 'column': 'name', 'values': ['M-Pesa Point']},
+}
+
+# Radii (km) within which the facilities are counted
+COUNT_RADII_KM = [1, 5]
+
+# Number of hexagons queried at once, to bound the memory used by the queries
+QUERY_BATCH_SIZE = 200_000
+
+def get_feature_columns(target, radii=COUNT_RADII_KM):
+    """Names of the distance column and of the count columns of a facility target."""
+    return f'dist_nearest_{target}_km', [f'n_{target}_within_{radius}km' for radius in radii]
+
+def load_facility_points(target, spec):
+    """Load the coordinates of the facilities of a target."""
+    file_path = os.path.join(PROCESSED_DATA_DIR, spec['file_name'])
+    column = spec.get('column')
+    points = pd.read_csv(file_path, usecols=['latitude', 'longitude'] + ([column] if column else []))
+    if column:
+        points = points[points[column].isin(spec['values'])]
+    points = points.dropna(subset=['latitude', 'longitude'])
+    print(f'[INFO] Loaded {len(points)} {target} points from {file_path}')
+    return points
+
+def compute_facility_features(target, facility_latitudes, facility_longitudes, hex_vectors, radii=COUNT_RADII_KM,
+                              batch_size=QUERY_BATCH_SIZE):
+    """
+    Compute the distance to the nearest facility and the number of facilities within the radii
+    of every hexagon center, with batched queries on a KD-tree of the facilities.
+
+    The facilities are indexed as 3D unit vectors, where the euclidean (chord) distance is a
+    monotonic function of the great-circle distance, so the nearest neighbours and the radius
+    queries are exact on the sphere.
+
+    Parameters:
+    target (str): Name of the facility target
+    facility_latitudes (array-like): Latitudes of the facilities
+    facility_longitudes (array-like): Longitudes of the facilities
+    hex_vectors (numpy.ndarray): Unit vectors of the hexagon centers
+    radii (list): Radii (km) within which the facilities are counted
+    batch_size (int): Number of hexagons queried at once
+
+    Returns:
+    dict: float32 distance column and uint32 count columns, by column name
+    """
+    distance_column, count_columns = get_feature_columns(target, radii)
+    n_hexagons = hex_vectors.shape[0]
+    features = {distance_column: np.full(n_hexagons, np.nan, dtype=np.float32)}
+    features.update({column: np.zeros(n_hexagons, dtype=np.uint32) for column in count_columns})
+    if len(facility_latitudes) == 0:
+        return features
+
+    tree = cKDTree(to_unit_vectors(facility_latitudes, facility_longitudes))
+    radii_chords = km_to_chord(np.asarray(radii, dtype=np.float64))
+    for start in range(0, n_hexagons, batch_size):
+        batch = hex_vectors[start:start + batch_size]
+        chords, _ = tree.query(batch, k=1)
+        features[distance_column][start:start + batch_size] = chord_to_km(chords)
+        for column, radius_chord in zip(count_columns, radii_chords):
+            features[column][start:start + batch_size] = tree.query_ball_point(batch, radius_chord, return_length=True)
+    return features
+
+def add_facility_features(h3_data, targets=FACILITY_TARGETS, radii=COUNT_RADII_KM, workers=1):
+    """
+    Add the distance and count features of every facility target to the h3 data.
+
+    Parameters:
+    h3_data (pandas.DataFrame): h3 data with a uint64 'h3' column, and the 'latitude' and
+        'longitude' columns (computed from the cells when missing)
+    targets (dict): Facility targets, see FACILITY_TARGETS
+    radii (list): Radii (km) within which the facilities are counted
+    workers (int): Number of worker processes the targets are spread over, None to use all the cores
+
+    Returns:
+    pandas.DataFrame: h3 data with the feature columns
+    """
+    if 'latitude' not in h3_data.columns:
+        h3_data['latitude'], h3_data['longitude'] = h3_to_geo_array(h3_data['h3'].to_numpy())
+    hex_vectors = to_unit_vectors(h3_data['latitude'].to_numpy(), h3_data['longitude'].to_numpy())
+    facilities = {}
+    for target, spec in targets.items():
+        try:
+            points = load_facility_points(target, spec)
+        except FileNotFoundError:
+            print(f'[WARNING] No points file found for the {target} target, skipping it')
+            continue
+        facilities[target] = (points['latitude'].to_numpy(), points['longitude'].to_numpy())
+    print()
+
+    if workers is None:
+        workers = os.cpu_count()
+    features = {}
+    if workers == 1 or len(facilities) <= 1:
+        for target, (latitudes, longitudes) in facilities.items():
+            features.update(compute_facility_features(target, latitudes, longitudes, hex_vectors, radii))
+    else:
+        print(f'[INFO] Computing the features of {len(facilities)} targets with {workers} worker processes...')
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(compute_facility_features, target, latitudes, longitudes, hex_vectors, radii)
+                for target, (latitudes, longitudes) in facilities.items()
+            ]
+            for future in futures:
+                features.update(future.result())
+
+    return replace_columns(h3_data, pd.DataFrame(features, index=h3_data.index))
+
+def main(workers=1):
+    update_h3_data_file(
+        os.path.join(PROCESSED_DATA_DIR, 'KEN_h3_data_full.csv'),
+        lambda h3_data: add_facility_features(h3_data, workers=workers),
+        'the facility features'
+    )
+
+if __name__ == "__main__":
+    main()
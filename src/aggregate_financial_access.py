@@ -0,0 +1,159 @@
+'''
+This script adds a financial access surface to the h3 hexagons, for branch expansion work. For
+every hexagon of KEN_h3_data_full, it counts the banks, SACCOs, M-Pesa points and POSTA offices
+within 1, 2 and 5 rings of hexagons, the population living within these rings, and the number
+of outlets per 10,000 people. The outlets are read from the normalized output of
+process_financial_services_points.py.
+'''
+import pandas as pd
+import numpy as np
+import os
+from h3_utils import H3_RESOLUTION, geo_to_h3_array, find_in_sorted, get_grid_cells, load_or_build_neighbour_table, replace_columns, update_h3_data_file
+
+PROCESSED_DATA_DIR = '../../data/processed'
+
+# Outlets counted around the hexagons: column of the financial services points and the values
+# identifying the outlets (the names are the ones standardized by process_names)
+OUTLET_TYPES = {
+    'bank': {'column': 'amenity', 'values': ['bank']},
+    'sacco': {'column': 'name', 'values': ['Savings and Credit Cooperative Organization']},
+    'mpesa': {'column': 'name', 'values': ['M-Pesa Point']},
+    'posta': {'column': 'name', 'values': ['POSTA']},
+}
+
+# Number of rings of hexagons around every hexagon the outlets and population are summed over
+RING_RADII = [1, 2, 5]
+
+# Number of source cells expanded at once, to bound the memory used by the ring expansion
+EXPANSION_CHUNK_SIZE = 50_000
+
+def load_outlets(outlet_types=OUTLET_TYPES):
+    """
+    Load the financial services points and flag the outlets of every type.
+
+    Returns:
+    pandas.DataFrame: 'latitude', 'longitude' and one boolean column per outlet type
+    """
+    file_path = os.path.join(PROCESSED_DATA_DIR, 'KEN_financial_services_points.csv')
+    print('[INFO] Attempting to load the financial services points...')
+    columns = sorted({spec['column'] for spec in outlet_types.values()})
+    points = pd.read_csv(file_path, usecols=columns + ['latitude', 'longitude']).dropna(subset=['latitude', 'longitude'])
+    outlets = points[['latitude', 'longitude']].copy()
+    for outlet_type, spec in outlet_types.items():
+        outlets[outlet_type] = points[spec['column']].isin(spec['values'])
+        print(f'[INFO] {outlets[outlet_type].sum()} {outlet_type} outlets')
+    print(f'[INFO] Successfully loaded the financial services points from {file_path}\n')
+    return outlets
+
+def ring_window_sums(neighbours, source_positions, weights, radii=RING_RADII, chunk_size=EXPANSION_CHUNK_SIZE):
+    """
+    Sum the weights of the source cells within every radius (in rings) of every cell of the grid.
+
+    The disk around every source is grown one ring at a time over the neighbour table, as
+    (source, cell) pairs of integer ids. A ring only has neighbours in the previous ring, in
+    itself and in the next ring, so the next ring is the neighbours of the current ring that
+    are in neither of the two. The weights of every ring are added to its cells with bincount.
+
+    Parameters:
+    neighbours (numpy.ndarray): Neighbour table of the grid, see build_neighbour_table
+    source_positions (numpy.ndarray): Sorted unique positions of the source cells in the grid
+    weights (numpy.ndarray): (n_sources, n_weights) weights of the source cells
+    radii (list): Radii, in rings, of the windows
+    chunk_size (int): Number of sources expanded at once
+
+    Returns:
+    dict: (n_cells, n_weights) float64 window sums by radius
+    """
+    n_cells = neighbours.shape[0]
+    n_weights = weights.shape[1]
+    totals = np.zeros((n_cells, n_weights))
+    window_sums = {radius: np.zeros((n_cells, n_weights)) for radius in radii}
+
+    def add_ring(ring_sources, ring_cells, chunk_weights):
+        for column in range(n_weights):
+            totals[:, column] += np.bincount(ring_cells, weights=chunk_weights[ring_sources, column], minlength=n_cells)
+
+    for start in range(0, len(source_positions), chunk_size):
+        chunk_positions = source_positions[start:start + chunk_size]
+        chunk_weights = weights[start:start + chunk_size]
+        ring_keys = np.arange(chunk_positions.size, dtype=np.int64) * n_cells + chunk_positions
+        previous_keys = np.empty(0, dtype=np.int64)
+        totals[:] = 0
+        add_ring(ring_keys // n_cells, ring_keys % n_cells, chunk_weights)
+
+        for radius in range(1, max(radii) + 1):
+            ring_sources = ring_keys // n_cells
+            ring_neighbours = neighbours[ring_keys % n_cells]
+            valid = ring_neighbours >= 0
+            candidate_keys = np.unique(np.repeat(ring_sources, 6)[valid.ravel()] * n_cells + ring_neighbours[valid])
+            candidate_keys = candidate_keys[~find_in_sorted(candidate_keys, ring_keys)[1]]
+            candidate_keys = candidate_keys[~find_in_sorted(candidate_keys, previous_keys)[1]]
+            previous_keys, ring_keys = ring_keys, candidate_keys
+            add_ring(ring_keys // n_cells, ring_keys % n_cells, chunk_weights)
+            if radius in window_sums:
+                window_sums[radius] += totals
+    return window_sums
+
+def compact_counts(counts):
+    """Convert counts to the smallest unsigned integer type fitting them."""
+    counts = np.rint(counts)
+    dtype = np.min_scalar_type(int(counts.max())) if counts.size else np.uint8
+    return counts.astype(dtype)
+
+def add_financial_access(h3_data, outlets, outlet_types=OUTLET_TYPES, radii=RING_RADII, resolution=H3_RESOLUTION):
+    """
+    Add the outlet counts, population and outlets per 10,000 people within every radius to the h3 data.
+
+    Parameters:
+    h3_data (pandas.DataFrame): h3 data with uint64 'h3' and 'total_population' columns
+    outlets (pandas.DataFrame): Outlets returned by load_outlets
+    outlet_types (dict): Outlet types, see OUTLET_TYPES
+    radii (list): Radii, in rings, of the windows
+    resolution (int): h3 resolution of the hexagons
+
+    Returns:
+    pandas.DataFrame: h3 data with the financial access columns
+    """
+    h3_cells = h3_data['h3'].to_numpy(dtype=np.uint64)
+    grid_cells = get_grid_cells(np.unique(h3_cells), resolution)
+    neighbours = load_or_build_neighbour_table(grid_cells, PROCESSED_DATA_DIR, resolution)
+    hex_positions = np.searchsorted(grid_cells, h3_cells)
+
+    # Weights of every grid cell: number of outlets of every type, then population
+    outlet_names = list(outlet_types)
+    outlet_cells = geo_to_h3_array(outlets['latitude'].to_numpy(), outlets['longitude'].to_numpy(), resolution)
+    outlet_positions, in_grid = find_in_sorted(outlet_cells, grid_cells)
+    print(f'[INFO] {in_grid.sum()} out of {len(outlets)} outlets are in the grid')
+    cell_weights = np.zeros((grid_cells.size, len(outlet_names) + 1))
+    for column, outlet_type in enumerate(outlet_names):
+        cell_weights[:, column] = np.bincount(
+            outlet_positions[in_grid], weights=outlets[outlet_type].to_numpy(dtype=np.float64)[in_grid], minlength=grid_cells.size
+        )
+    np.add.at(cell_weights[:, -1], hex_positions, np.nan_to_num(h3_data['total_population'].to_numpy(dtype=np.float64)))
+
+    source_positions = np.flatnonzero(cell_weights.any(axis=1))
+    print(f'[INFO] Summing the outlets and population of {source_positions.size} cells within {radii} rings...')
+    window_sums = ring_window_sums(neighbours, source_positions, cell_weights[source_positions], radii)
+
+    access_columns = {}
+    for radius in radii:
+        sums = window_sums[radius][hex_positions]
+        population = sums[:, -1]
+        access_columns[f'population_within_{radius}_rings'] = population.astype(np.float32)
+        for column, outlet_type in enumerate(outlet_names):
+            access_columns[f'n_{outlet_type}_within_{radius}_rings'] = compact_counts(sums[:, column])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                per_10k = np.where(population > 0, sums[:, column] / population * 10_000, np.nan)
+            access_columns[f'{outlet_type}_per_10k_pop_within_{radius}_rings'] = per_10k.astype(np.float32)
+
+    return replace_columns(h3_data, pd.DataFrame(access_columns, index=h3_data.index))
+
+def main():
+    update_h3_data_file(
+        os.path.join(PROCESSED_DATA_DIR, 'KEN_h3_data_full.csv'),
+        lambda h3_data: add_financial_access(h3_data, load_outlets()),
+        'the financial access surface'
+    )
+
+if __name__ == "__main__":
+    main()
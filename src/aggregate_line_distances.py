@@ -0,0 +1,128 @@
+'''
+This script links the railways and waterways lines to the h3 hexagons. Every line is rasterized
+into the h3 cells it crosses, then a multi-source breadth-first search over the h3 neighbour
+graph gives every hexagon of KEN_h3_data_full its grid distance (number of cells) to the
+nearest railway and to the nearest waterway.
+'''
+import geopandas as gpd
+import pandas as pd
+import numpy as np
+import os
+import shapely
+from h3.api import basic_int as h3_int
+from h3_utils import H3_RESOLUTION, geo_to_h3_array, find_in_sorted, get_grid_cells, load_or_build_neighbour_table, replace_columns, update_h3_data_file
+from process_points_of_interest import RAILWAYS_DIR, WATERWAYS_DIR
+
+RAW_DATA_DIR = '../../data/raw'
+PROCESSED_DATA_DIR = '../../data/processed'
+
+# Line layers rasterized onto the grid, by name of the distance feature
+LINE_FILES = {
+    'railway': os.path.join(RAILWAYS_DIR, 'ken_railways_lines.gpkg'),
+    'waterway': os.path.join(WATERWAYS_DIR, 'ken_waterways_lines.gpkg'),
+}
+
+# Maximum distance (degrees, about 20m) between two consecutive vertices of the densified lines,
+# well below the size of a resolution 8 cell so that only the cells a line barely clips at a
+# corner can be skipped
+DENSIFY_STEP_DEG = 0.0002
+
+def load_line_geometries(name, relative_path):
+    """Load the geometries of a line layer, exploded into single LineStrings in EPSG:4326."""
+    print(f'[INFO] Attempting to load the {name} lines...')
+    file_path = os.path.join(RAW_DATA_DIR, relative_path)
+    # Only the geometries are used, so none of the attribute columns are read
+    lines = gpd.read_file(file_path, engine='pyogrio', columns=[])
+    if lines.crs is not None:
+        lines = lines.to_crs('EPSG:4326')
+    geometries = lines.geometry.explode(index_parts=False)
+    geometries = geometries[~geometries.is_empty & geometries.notna()]
+    print(f'[INFO] {len(geometries)} {name} lines loaded from {file_path}\n')
+    return geometries
+
+def rasterize_lines(geometries, resolution=H3_RESOLUTION, step=DENSIFY_STEP_DEG):
+    """
+    Find the h3 cells crossed by lines.
+
+    The lines are densified so that consecutive vertices are at most step degrees apart, and all
+    the vertices are assigned to their cell in a single call. The few consecutive vertices whose
+    cells are still not neighbours are joined with the h3 line between their cells.
+
+    Parameters:
+    geometries (GeoSeries): LineStrings in EPSG:4326
+    resolution (int): h3 resolution of the cells
+    step (float): Maximum distance (degrees) between consecutive vertices
+
+    Returns:
+    numpy.ndarray: Sorted unique uint64 cells crossed by the lines
+    """
+    if len(geometries) == 0:
+        return np.empty(0, dtype=np.uint64)
+    densified = shapely.segmentize(np.asarray(geometries.values), step)
+    coordinates, line_ids = shapely.get_coordinates(densified, return_index=True)
+    cells = geo_to_h3_array(coordinates[:, 1], coordinates[:, 0], resolution)
+
+    jumps = np.flatnonzero((line_ids[1:] == line_ids[:-1]) & (cells[1:] != cells[:-1]))
+    gap_cells = []
+    for start, end in zip(cells[jumps].tolist(), cells[jumps + 1].tolist()):
+        if not h3_int.h3_indexes_are_neighbors(start, end):
+            gap_cells.extend(h3_int.h3_line(start, end))
+    return np.unique(np.concatenate([cells, np.array(gap_cells, dtype=np.uint64)]))
+
+def multi_source_bfs(neighbours, sources):
+    """
+    Grid distance of every cell to the nearest source cell, with a breadth-first search run
+    from all the sources at once. Every level of the search is expanded with array operations
+    on the neighbour table.
+
+    Parameters:
+    neighbours (numpy.ndarray): Neighbour table returned by build_neighbour_table
+    sources (numpy.ndarray): Positions of the source cells
+
+    Returns:
+    numpy.ndarray: int32 distance of every cell, -1 for the cells no source can reach
+    """
+    distances = np.full(neighbours.shape[0], -1, dtype=np.int32)
+    frontier = np.unique(sources)
+    distances[frontier] = 0
+    level = 0
+    while frontier.size:
+        level += 1
+        candidates = neighbours[frontier].ravel()
+        candidates = candidates[candidates >= 0]
+        frontier = np.unique(candidates[distances[candidates] < 0])
+        distances[frontier] = level
+    return distances
+
+def add_line_distances(h3_data, line_files=LINE_FILES, resolution=H3_RESOLUTION):
+    """
+    Add the grid distance to the nearest line of every layer to the h3 data.
+
+    Parameters:
+    h3_data (pandas.DataFrame): h3 data with a uint64 'h3' column
+    line_files (dict): Paths of the line layers, relative to RAW_DATA_DIR, by feature name
+    resolution (int): h3 resolution of the hexagons
+
+    Returns:
+    pandas.DataFrame: h3 data with a nullable integer '<name>_grid_distance' column per layer
+    """
+    h3_cells = h3_data['h3'].to_numpy(dtype=np.uint64)
+    grid_cells = get_grid_cells(np.unique(h3_cells), resolution)
+    neighbours = load_or_build_neighbour_table(grid_cells, PROCESSED_DATA_DIR, resolution)
+    hex_positions = np.searchsorted(grid_cells, h3_cells)
+
+    distance_columns = {}
+    for name, relative_path in line_files.items():
+        line_cells = rasterize_lines(load_line_geometries(name, relative_path), resolution)
+        sources, in_grid = find_in_sorted(line_cells, grid_cells)
+        sources = sources[in_grid]
+        print(f'[INFO] {name} lines cross {line_cells.size} cells, {sources.size} of them in the grid')
+        distances = multi_source_bfs(neighbours, sources)[hex_positions]
+        distance_columns[f'{name}_grid_distance'] = pd.array(np.where(distances >= 0, distances, None), dtype='Int32')
+    return replace_columns(h3_data, pd.DataFrame(distance_columns, index=h3_data.index))
+
+def main():
+    update_h3_data_file(os.path.join(PROCESSED_DATA_DIR, 'KEN_h3_data_full.csv'), add_line_distances, 'the line distances')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+'''
+This script attaches the points of interest and the financial services points to the h3 hexagons.
+It assigns every point exported by process_points_of_interest.py and
+process_financial_services_points.py to its h3 cell, counts the points of every category (and
+of every amenity) in each hexagon, and adds these counts to KEN_h3_data_full as integer columns,
+so that the users of the dataset do not have to join the points to the hexagons themselves.
+'''
+import pandas as pd
+import numpy as np
+import os
+import re
+from scipy import sparse
+from h3_utils import H3_RESOLUTION, geo_to_h3_array, find_in_sorted, replace_columns, update_h3_data_file
+from process_points_of_interest import POI_CATEGORIES
+
+PROCESSED_DATA_DIR = '../../data/processed'
+
+# Csv files of the points counted in the hexagons, by category
+POINT_FILES = {category: spec['file_name'] for category, spec in POI_CATEGORIES.items()}
+POINT_FILES['financial_services'] = 'KEN_financial_services_points.csv'
+
+# Prefixes of the count columns added to the h3 data
+CATEGORY_COLUMN_PREFIX = 'poi_count_'
+AMENITY_COLUMN_PREFIX = 'amenity_count_'
+
+# Whether to add a count column for every amenity, on top of the count of every category
+INCLUDE_AMENITY_COUNTS = True
+
+def load_points(point_files=POINT_FILES):
+    """
+    Load the coordinates and amenity of the points of every category.
+
+    Returns:
+    pandas.DataFrame: 'category', 'amenity', 'latitude' and 'longitude' of all the points
+    """
+    points_list = []
+    for category, file_name in point_files.items():
+        file_path = os.path.join(PROCESSED_DATA_DIR, file_name)
+        if not os.path.exists(file_path):
+            print(f'[WARNING] No points file found at {file_path}, skipping the {category} category')
+            continue
+        points = pd.read_csv(file_path, usecols=['amenity', 'latitude', 'longitude'])
+        points['category'] = category
+        points_list.append(points)
+        print(f'[INFO] Loaded {len(points)} {category} points from {file_path}')
+    print()
+    return pd.concat(points_list, ignore_index=True)
+
+def get_column_label(value):
+    """Lowercase label of an amenity or category usable in a column name."""
+    label = re.sub(r'[^0-9a-z]+', '_', str(value).lower()).strip('_')
+    return label or 'unknown'
+
+def build_count_matrix(hex_cells, point_cells, labels):
+    """
+    Count the points of every label in every hexagon with a sparse hexagon x label matrix.
+
+    Parameters:
+    hex_cells (numpy.ndarray): Sorted uint64 cells of the hexagons
+    point_cells (numpy.ndarray): uint64 cell of every point
+    labels (array-like): Label of every point
+
+    Returns:
+    tuple: CSR count matrix (one row per hexagon) and the labels of its columns
+    """
+    positions, in_hexagons = find_in_sorted(point_cells, hex_cells)
+
+    label_codes, label_names = pd.factorize(pd.Series(labels)[in_hexagons], sort=True)
+    counts = sparse.coo_matrix(
+        (np.ones(label_codes.size, dtype=np.int32), (positions[in_hexagons], label_codes)),
+        shape=(hex_cells.size, label_names.size)
+    ).tocsr()
+    return counts, np.asarray(label_names)
+
+def count_matrix_to_columns(counts, column_names, index):
+    """Convert a count matrix to a DataFrame of the smallest unsigned integer type fitting the counts."""
+    dtype = np.min_scalar_type(counts.max()) if counts.nnz else np.uint8
+    return pd.DataFrame(counts.toarray().astype(dtype), index=index, columns=column_names)
+
+def add_point_counts(h3_data, points, include_amenity_counts=INCLUDE_AMENITY_COUNTS, resolution=H3_RESOLUTION):
+    """
+    Add the count columns of the points of every category (and amenity) to the h3 data.
+
+    Parameters:
+    h3_data (pandas.DataFrame): h3 data with a uint64 'h3' column
+    points (pandas.DataFrame): Points returned by load_points
+    include_amenity_counts (bool): Whether to add the count columns of every amenity
+    resolution (int): h3 resolution of the hexagons
+
+    Returns:
+    pandas.DataFrame: h3 data with the count columns
+    """
+    points = points.dropna(subset=['latitude', 'longitude'])
+    point_cells = geo_to_h3_array(points['latitude'].to_numpy(), points['longitude'].to_numpy(), resolution)
+
+    hex_cells = h3_data['h3'].to_numpy(dtype=np.uint64)
+    order = np.argsort(hex_cells, kind='stable')
+    sorted_cells = hex_cells[order]
+    # Rows of the count matrices in the order of the h3 data
+    rows = np.empty_like(order)
+    rows[order] = np.arange(order.size)
+
+    category_labels = points['category'].map(get_column_label).to_numpy()
+    counts, labels = build_count_matrix(sorted_cells, point_cells, category_labels)
+    print(f'[INFO] {counts.sum()} out of {len(points)} points fall in the hexagons of the h3 data')
+    count_columns = [count_matrix_to_columns(counts[rows], [CATEGORY_COLUMN_PREFIX + label for label in labels], h3_data.index)]
+
+    if include_amenity_counts:
+        amenity_labels = points['amenity'].map(get_column_label).to_numpy()
+        counts, labels = build_count_matrix(sorted_cells, point_cells, amenity_labels)
+        count_columns.append(count_matrix_to_columns(counts[rows], [AMENITY_COLUMN_PREFIX + label for label in labels], h3_data.index))
+
+    # Drop all the count columns of a previous run, whose labels may not exist anymore
+    previous_columns = [column for column in h3_data.columns if column.startswith((CATEGORY_COLUMN_PREFIX, AMENITY_COLUMN_PREFIX))]
+    return replace_columns(h3_data, pd.concat(count_columns, axis=1), previous_columns)
+
+def main():
+    update_h3_data_file(
+        os.path.join(PROCESSED_DATA_DIR, 'KEN_h3_data_full.csv'),
+        lambda h3_data: add_point_counts(h3_data, load_points()),
+        'the point counts'
+    )
+
+if __name__ == "__main__":
+    main()
@@ -417,27 +417,29 @@ import pandas as pd
 import numpy as np
 from shapely.geometry import Polygon, Point
 import time 
+from h3_utils import geo_to_h3_array, h3_int_to_str_array, h3_to_geo_array
 
 app = dash.Dash(__name__)
 
 def load_population_density():
     gdf = gpd.read_file('../../data/kontur_population_KE_20231101.gpkg')
-    gdf = gdf.to_crs(epsg=4326)
-    gdf['lat'] = gdf.geometry.centroid.y
-    gdf['lon'] = gdf.geometry.centroid.x
+    # The hexagon centers are shared with the processing scripts through the centroid cache
+    gdf['lat'], gdf['lon'] = h3_to_geo_array(gdf['h3'].to_numpy())
     return gdf
 
 def precompute_hexagons(df, min_res=3, max_res=8):
     hex_json = {}
     for res in range(min_res, max_res + 1):
         print(f"Processing resolution {res}...")
-        df['h3'] = df.apply(lambda row: h3.geo_to_h3(row['lat'], row['lon'], res), axis=1)
+        # Cells are grouped as uint64 and only converted to strings for the GeoJSON ids
+        df['h3'] = geo_to_h3_array(df['lat'].to_numpy(), df['lon'].to_numpy(), res)
         
         grouped = df.groupby('h3').agg({
             'population': 'sum',
             'lat': 'mean',
             'lon': 'mean'
         }).reset_index()
+        grouped['h3'] = h3_int_to_str_array(grouped['h3'].to_numpy())
         
         geojson_features = []
         for _, row in grouped.iterrows():
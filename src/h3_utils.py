@@ -0,0 +1,333 @@
+'''
+This script contains helpers shared by the other scripts to work with h3 indices on whole
+arrays at once, instead of calling the h3 library row by row through DataFrame.apply, and to
+measure great-circle distances between coordinates.
+'''
+import warnings
+import numpy as np
+import pandas as pd
+import os
+from h3.api import basic_int as h3_int
+from shapely.geometry import box, mapping
+
+# The vectorized functions of h3-py live under h3.unstable, which warns on import
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore')
+    from h3.unstable import vect as h3_vect
+
+H3_RESOLUTION = 8
+
+EARTH_RADIUS_KM = 6371.0088
+
+# The h3 cells are kept as uint64 through the pipeline and only converted to strings when exported
+EXPORT_H3_AS_STRING = True
+
+# Margin (degrees) added around the hexagons when building the grid of the neighbour table, so
+# that the sources just outside the hexagons (lines, outlets) are taken into account
+GRID_MARGIN_DEG = 0.5
+
+# Centroids computed by any script are memoized in this file so that the next stages reuse them
+CENTROID_CACHE_FILE = '../output/h3_centroids.npz'
+
+# In-process memo of the centroids: sorted uint64 cells with their latitudes and longitudes
+_centroid_memo = None
+
+def geo_to_h3_array(lats, lngs, resolution=H3_RESOLUTION):
+    """
+    Assign an h3 cell to every (lat, lng) pair in a single call.
+
+    Parameters:
+    lats (array-like): Latitudes in degrees (WGS84)
+    lngs (array-like): Longitudes in degrees (WGS84)
+    resolution (int): h3 resolution of the output cells
+
+    Returns:
+    numpy.ndarray: uint64 array with the h3 cell of every coordinate
+    """
+    lats = np.ascontiguousarray(lats, dtype=np.float64)
+    lngs = np.ascontiguousarray(lngs, dtype=np.float64)
+    return h3_vect.geo_to_h3(lats, lngs, resolution)
+
+def h3_to_parent_array(cells, resolution):
+    """
+    Compute the parent cell at a coarser resolution of every cell of an array.
+
+    The parent is obtained with bit operations on the index, by setting its resolution field
+    and marking the digits of the finer resolutions as unused.
+
+    Parameters:
+    cells (array-like): uint64 h3 cells, all at a resolution finer than or equal to resolution
+    resolution (int): h3 resolution of the parent cells
+
+    Returns:
+    numpy.ndarray: uint64 array with the parent of every cell
+    """
+    cells = np.asarray(cells, dtype=np.uint64)
+    resolution_mask = np.uint64(0xF << 52)
+    unused_digits = np.uint64((1 << (3 * (15 - resolution))) - 1)
+    return (cells & ~resolution_mask) | np.uint64(resolution << 52) | unused_digits
+
+def h3_int_to_str_array(cells):
+    """
+    Convert an array of integer h3 cells to their 15 character hexadecimal representation.
+
+    Parameters:
+    cells (array-like): Integer h3 cells
+
+    Returns:
+    numpy.ndarray: Object array of h3 strings
+    """
+    return np.array([format(cell, 'x') for cell in np.asarray(cells, dtype=np.uint64).tolist()], dtype=object)
+
+def h3_str_to_int_array(values):
+    """
+    Convert an array of h3 strings to their uint64 representation.
+
+    Parameters:
+    values (array-like): h3 cells as hexadecimal strings
+
+    Returns:
+    numpy.ndarray: uint64 array of h3 cells
+    """
+    return np.fromiter((int(value, 16) for value in values), dtype=np.uint64, count=len(values))
+
+def h3_to_int_array(values):
+    """
+    Convert h3 cells given either as strings or as integers to a uint64 array.
+    Used when loading files written by the other scripts, which export the cells as strings.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind in 'iu':
+        return values.astype(np.uint64, copy=False)
+    return h3_str_to_int_array(values)
+
+def h3_column_to_str(df, column='h3'):
+    """
+    Returns a copy of the DataFrame with its uint64 h3 column converted to strings.
+    The cells are kept as integers through the pipeline and only converted when exporting.
+    """
+    return df.assign(**{column: h3_int_to_str_array(df[column].to_numpy())})
+
+def find_in_sorted(values, sorted_values):
+    """
+    Look up values in a sorted array with a binary search, instead of hashing or sorting them.
+
+    Returns:
+    tuple: Position of every value in sorted_values (meaningless for the values not found) and
+        the boolean mask of the values found
+    """
+    values = np.asarray(values)
+    if sorted_values.size == 0:
+        return np.zeros(values.shape, dtype=np.intp), np.zeros(values.shape, dtype=bool)
+    positions = np.minimum(np.searchsorted(sorted_values, values), sorted_values.size - 1)
+    return positions, sorted_values[positions] == values
+
+def left_join_on_h3(left, right, column='h3', presorted=False):
+    """
+    Left join two DataFrames on their uint64 h3 column (the cells of right must be unique).
+
+    The right cells are sorted once and looked up with searchsorted instead of hashing the keys.
+    Rows of left without a match get NaN values, as with pd.merge(how='left').
+
+    Parameters:
+    left (pandas.DataFrame): Left DataFrame, whose row order is kept
+    right (pandas.DataFrame): Right DataFrame with unique h3 cells
+    column (str): Name of the h3 column in both DataFrames
+    presorted (bool): Whether right is already sorted by its h3 column, so that joining many
+        left DataFrames to the same right one does not sort it again every time
+
+    Returns:
+    pandas.DataFrame: Left DataFrame with the other columns of right appended
+    """
+    right_columns = [right_column for right_column in right.columns if right_column != column]
+    if len(right) == 0:
+        # Nothing can match, every joined column is all NaN
+        return left.assign(**{right_column: pd.Series(np.nan, index=left.index) for right_column in right_columns})
+
+    right_cells = right[column].to_numpy(dtype=np.uint64)
+    if presorted:
+        sorted_cells = right_cells
+    else:
+        order = np.argsort(right_cells, kind='stable')
+        sorted_cells = right_cells[order]
+    left_cells = left[column].to_numpy(dtype=np.uint64)
+
+    positions, matched = find_in_sorted(left_cells, sorted_cells)
+    source_rows = positions if presorted else order[positions]
+
+    joined_columns = {}
+    for right_column in right_columns:
+        values = pd.Series(np.asarray(right[right_column])[source_rows], index=left.index)
+        joined_columns[right_column] = values.where(matched)
+    return left.assign(**joined_columns)
+
+def load_centroid_memo(cache_file=CENTROID_CACHE_FILE):
+    """Returns the in-process centroid memo, initialized from the cache file on first use."""
+    global _centroid_memo
+    if _centroid_memo is None:
+        _centroid_memo = (np.empty(0, dtype=np.uint64), np.empty(0), np.empty(0))
+        if cache_file is not None and os.path.exists(cache_file):
+            try:
+                with np.load(cache_file) as cached:
+                    _centroid_memo = (cached['cells'], cached['lats'], cached['lngs'])
+            except Exception as e:
+                print(f'[WARNING] Could not read the centroid cache {cache_file}: {str(e)}')
+    return _centroid_memo
+
+def h3_to_geo_array(cells, cache_file=CENTROID_CACHE_FILE):
+    """
+    Compute the centers of an array of h3 cells.
+
+    Centroids are memoized in-process and in cache_file, so only the cells never seen by any
+    stage are computed with the h3 library.
+
+    Parameters:
+    cells (array-like): h3 cells, as uint64 or strings
+    cache_file (str): Path of the on-disk centroid cache, None to only memoize in-process
+
+    Returns:
+    tuple: float64 arrays of latitudes and longitudes of the cell centers
+    """
+    global _centroid_memo
+    unique_cells, inverse = np.unique(h3_to_int_array(cells), return_inverse=True)
+    memo_cells, memo_lats, memo_lngs = load_centroid_memo(cache_file)
+
+    positions = np.searchsorted(memo_cells, unique_cells)
+    known = positions < memo_cells.size
+    known[known] = memo_cells[positions[known]] == unique_cells[known]
+    missing_cells = unique_cells[~known]
+    if missing_cells.size:
+        missing_centers = np.array([h3_int.h3_to_geo(cell) for cell in missing_cells.tolist()], dtype=np.float64)
+        order = np.argsort(np.concatenate([memo_cells, missing_cells]), kind='stable')
+        memo_cells = np.concatenate([memo_cells, missing_cells])[order]
+        memo_lats = np.concatenate([memo_lats, missing_centers[:, 0]])[order]
+        memo_lngs = np.concatenate([memo_lngs, missing_centers[:, 1]])[order]
+        _centroid_memo = (memo_cells, memo_lats, memo_lngs)
+        if cache_file is not None:
+            try:
+                os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+                tmp_file = f'{cache_file}.{os.getpid()}.tmp.npz'
+                np.savez(tmp_file, cells=memo_cells, lats=memo_lats, lngs=memo_lngs)
+                os.replace(tmp_file, cache_file)
+            except Exception as e:
+                print(f'[WARNING] Could not update the centroid cache {cache_file}: {str(e)}')
+        positions = np.searchsorted(memo_cells, unique_cells)
+
+    return memo_lats[positions][inverse], memo_lngs[positions][inverse]
+
+def get_grid_cells(h3_cells, resolution=H3_RESOLUTION, margin=GRID_MARGIN_DEG):
+    """Sorted cells of the bounding box of the hexagons expanded by margin degrees."""
+    latitudes, longitudes = h3_to_geo_array(h3_cells)
+    bbox = box(longitudes.min() - margin, latitudes.min() - margin, longitudes.max() + margin, latitudes.max() + margin)
+    grid_cells = h3_int.polyfill(mapping(bbox), resolution, geo_json_conformant=True)
+    grid_cells = np.fromiter(grid_cells, dtype=np.uint64, count=len(grid_cells))
+    return np.union1d(grid_cells, h3_cells)
+
+def build_neighbour_table(grid_cells):
+    """
+    Build the neighbour table of the grid: row i holds the positions in grid_cells of the (up to
+    6) neighbours of cell i, -1 for the missing neighbours (outside the grid, or pentagons).
+    """
+    neighbour_cells = np.zeros((grid_cells.size, 6), dtype=np.uint64)
+    for position, cell in enumerate(grid_cells.tolist()):
+        # k_ring is used instead of hex_ring, which fails on pentagons
+        ring = list(h3_int.k_ring(cell, 1) - {cell})
+        neighbour_cells[position, :len(ring)] = ring
+
+    positions, found = find_in_sorted(neighbour_cells, grid_cells)
+    return np.where(found, positions, -1).astype(np.int32)
+
+def load_or_build_neighbour_table(grid_cells, cache_dir, resolution=H3_RESOLUTION):
+    """
+    Loads the neighbour table cached in cache_dir if it was built for the same grid, otherwise
+    builds and saves it there.
+    """
+    file_path = os.path.join(cache_dir, f'KEN_h3_neighbours_res{resolution}.npz')
+    if os.path.exists(file_path):
+        with np.load(file_path) as cached:
+            if np.array_equal(cached['cells'], grid_cells):
+                print(f'[INFO] Neighbour table loaded from {file_path}\n')
+                return cached['neighbours']
+
+    print(f'[INFO] Building the neighbour table of {grid_cells.size} cells...')
+    neighbours = build_neighbour_table(grid_cells)
+    try:
+        np.savez(file_path, cells=grid_cells, neighbours=neighbours)
+        print(f'[INFO] Neighbour table saved to {file_path}\n')
+    except Exception as e:
+        print(f"An error occurred while saving the neighbour table: {str(e)}")
+    return neighbours
+
+def to_unit_vectors(latitudes, longitudes):
+    """Convert coordinates in degrees to 3D unit vectors on the sphere."""
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lng = np.radians(np.asarray(longitudes, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack([cos_lat * np.cos(lng), cos_lat * np.sin(lng), np.sin(lat)])
+
+def chord_to_km(chord):
+    """Convert chord lengths between unit vectors to great-circle (haversine) distances in km."""
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(chord / 2, 0, 1))
+
+def km_to_chord(distance_km):
+    """Convert great-circle distances in km to chord lengths between unit vectors."""
+    return 2 * np.sin(np.minimum(distance_km / (2 * EARTH_RADIUS_KM), np.pi / 2))
+
+def raise_on_failures(errors, total, task_name):
+    """
+    Print a summary of the tasks that failed in a batch and raise, once all of them were attempted.
+
+    Parameters:
+    errors (dict): Error message of every failed task, by task name
+    total (int): Number of tasks of the batch
+    task_name (str): Plural name of the tasks in the messages (e.g. 'age/sex files')
+
+    Raises:
+    RuntimeError: If any task failed
+    """
+    if errors:
+        print(f'[ERROR] {len(errors)} out of {total} {task_name} failed:')
+        for name, error in errors.items():
+            print(f'  - {name}: {error.splitlines()[0]}')
+        raise RuntimeError(f'Failed to process {len(errors)} {task_name}: {sorted(errors)}')
+
+def replace_columns(h3_data, columns, previous_columns=None):
+    """
+    Add columns to the h3 data, dropping the columns of a previous run first.
+
+    Parameters:
+    h3_data (pandas.DataFrame): h3 data
+    columns (pandas.DataFrame): New columns, indexed like h3_data
+    previous_columns (list): Columns of a previous run to drop, by default the columns of
+        h3_data named like the new ones
+
+    Returns:
+    pandas.DataFrame: h3 data with the new columns
+    """
+    if previous_columns is None:
+        previous_columns = [column for column in columns.columns if column in h3_data.columns]
+    return pd.concat([h3_data.drop(columns=previous_columns), columns], axis=1)
+
+def update_h3_data_file(file_path, add_columns, description):
+    """
+    Load an h3 data csv with uint64 cells, add columns to it and save it back in place.
+
+    Parameters:
+    file_path (str): Path of the h3 data csv
+    add_columns (callable): Function taking the h3 data and returning it with the new columns
+    description (str): Description of the new columns, for the log
+    """
+    print('[INFO] Attempting to load the h3 data...')
+    h3_data = pd.read_csv(file_path)
+    h3_data['h3'] = h3_to_int_array(h3_data['h3'])
+    print(f'[INFO] Successfully loaded {len(h3_data)} hexagons from {file_path}\n')
+
+    h3_data = add_columns(h3_data)
+
+    try:
+        if EXPORT_H3_AS_STRING:
+            h3_data['h3'] = h3_int_to_str_array(h3_data['h3'].to_numpy())
+        h3_data.to_csv(file_path, index=False)
+        print(f"[INFO] H3 data augmented with {description} successfully saved to {file_path}")
+    except Exception as e:
+        print(f"An error occurred while saving the DataFrame: {str(e)}")
@@ -1,121 +1,222 @@
-import geopandas as gpd 
 import pandas as pd
+import numpy as np
 import os
-import h3
+import sqlite3
+import pyogrio
+from contextlib import closing
+from h3_utils import h3_to_int_array, h3_to_geo_array, h3_column_to_str, left_join_on_h3, EXPORT_H3_AS_STRING
 
 RAW_DATA_DIR = '../../data/raw'
 PROCESSED_DATA_DIR = '../../data/processed'
 
+# Number of rows processed at a time by the population kernel (and by the chunked mode)
+POPULATION_CHUNK_SIZE = 65536
+
 def load_age_demographics():
     print('[INFO] Attempting to read the age demographics data..')
     file_name = 'KEN_agesex_aggregated.csv'
     file_path = os.path.join(PROCESSED_DATA_DIR, file_name)
     age_demographics_df = pd.read_csv(file_path)
+    age_demographics_df['h3'] = h3_to_int_array(age_demographics_df['h3'])
     print(f'[INFO] File found at {file_path}!\n')
     print('[INFO] Successfully loaded the age demographics data!\n')
     return age_demographics_df
 
-def load_population():
+def read_gpkg_attributes(file_path, columns, use_arrow=False):
+    """
+    Read only some attribute columns of the feature table of a GeoPackage, without parsing
+    (or reprojecting) the geometries.
+
+    Parameters:
+    file_path (str): Path to the GeoPackage
+    columns (list): Names of the attribute columns to read
+    use_arrow (bool): Whether to read through pyogrio's Arrow interface instead of querying
+        the GeoPackage's SQLite table directly
+
+    Returns:
+    pandas.DataFrame: DataFrame with the requested columns
+    """
+    if use_arrow:
+        return pyogrio.read_dataframe(file_path, columns=columns, read_geometry=False, use_arrow=True)
+
+    with closing(sqlite3.connect(f'file:{file_path}?mode=ro', uri=True)) as conn:
+        table_name = conn.execute(
+            "SELECT table_name FROM gpkg_contents WHERE data_type = 'features'"
+        ).fetchone()[0]
+        column_list = ', '.join(f'"{column}"' for column in columns)
+        return pd.read_sql_query(f'SELECT {column_list} FROM "{table_name}"', conn)
+
+def load_population(use_arrow=False):
     print('[INFO] Attempting to read the population data..')
     file_name = 'kontur_population_KE_20231101.gpkg'
     file_path = os.path.join(RAW_DATA_DIR, file_name)
-    population_df = gpd.read_file(file_path)
+    # Only the h3 index and population are used, so the hexagon polygons are never parsed
+    population_df = read_gpkg_attributes(file_path, ['h3', 'population'], use_arrow=use_arrow)
+    population_df['h3'] = h3_to_int_array(population_df['h3'])
     print(f'[INFO] File found at {file_path}!\n')
     print('[INFO] Successfully loaded the population data!\n')
     return population_df
     
-def get_pop_total_and_sum(df):
-    total_pop = df['total_population'].round().astype(int)
-    sum_gender = (df['total_male'].round().astype(int) + df['total_female'].round().astype(int))
+def compute_population_columns(block, population, male_mask, female_mask, chunk_size=POPULATION_CHUNK_SIZE):
+    """
+    Fused kernel computing all the population columns in a single pass over the band matrix.
 
-    # Count the number of rows where they match
-    matching_rows = (total_pop == sum_gender).sum()
-    return total_pop, sum_gender, matching_rows
+    The row sums of all the demographic columns, of the male columns and of the female
+    columns are computed together, chunk_size rows at a time, as the product of the float32
+    block with an indicator matrix. The block and the sums hold every row, only the copy with
+    the NaN values replaced by zeros is bounded by the chunk size.
 
-def process_population_data(df):
+    Parameters:
+    block (numpy.ndarray): float32 matrix (rows x demographic columns), NaN for missing values
+    population (numpy.ndarray): Recorded population of every row, NaN when missing
+    male_mask (numpy.ndarray): Boolean mask of the male columns of block
+    female_mask (numpy.ndarray): Boolean mask of the female columns of block
+    chunk_size (int): Number of rows processed at a time
+
+    Returns:
+    dict: Arrays for total_population (filled and corrected), total_male, total_female and
+        recorded_pop_diff, plus the number of rows matching the sum of gender totals before
+        and after the correction
+    """
+    # Columns of the indicator: all demographic columns, male columns, female columns
+    indicator = np.stack([np.ones(block.shape[1]), male_mask, female_mask], axis=1).astype(np.float64)
+    sums = np.empty((block.shape[0], 3), dtype=np.float64)
+    for start in range(0, block.shape[0], chunk_size):
+        chunk = np.nan_to_num(block[start:start + chunk_size], copy=True)
+        np.dot(chunk, indicator, out=sums[start:start + chunk_size])
+
+    # Fill missing population values with sum of demographic columns
+    total_population = np.where(np.isnan(population), sums[:, 0], population)
+    total_male = np.round(sums[:, 1]).astype(int)
+    total_female = np.round(sums[:, 2]).astype(int)
+    sum_gender = total_male + total_female
+
+    # negative value indicates that the sum is bigger than the recorded total pop from first dataset 
+    # positive value indicates that the recorded total pop from first dataset is bigger than the sum
+    total_pop = np.round(total_population).astype(int)
+    recorded_pop_diff = total_pop - sum_gender
+    matching_rows_before = int((total_pop == sum_gender).sum())
+
+    # Update the total_population to capture the max number of population
+    # (done after computing the difference to keep the original difference recorded)
+    total_population = np.where(sum_gender > total_population, sum_gender, total_population)
+    matching_rows_after = int((np.round(total_population).astype(int) == sum_gender).sum())
+
+    return {
+        'total_population': total_population,
+        'total_male': total_male,
+        'total_female': total_female,
+        'recorded_pop_diff': recorded_pop_diff,
+        'matching_rows_before': matching_rows_before,
+        'matching_rows_after': matching_rows_after,
+    }
+
+def process_population_data(df, chunk_size=POPULATION_CHUNK_SIZE, verbose=True):
     """
     Process population data by:
     1. Filling missing population values with sum of demographic columns
     2. Creating total male and female population columns
+    3. Recording the difference between the population and the sum of gender totals, then
+       raising the population to that sum where it is smaller
+
+    The demographic columns of all the rows of df are copied once into a float32 block (half
+    the size of the float64 columns) and all the columns are produced by
+    compute_population_columns in a single pass.
     
     Parameters:
     df (pandas.DataFrame): DataFrame containing population data
+    chunk_size (int): Number of rows processed at a time by the kernel
+    verbose (bool): Whether to print the number of rows matching the sum of gender totals
     
     Returns:
     pandas.DataFrame: Processed DataFrame with new columns
     """
-    # Create a copy to avoid modifying the original
-    processed_df = df.copy()
-    
     # Get all demographic columns (excluding 'h3', 'population', and 'geometry')
     demographic_cols = [col for col in df.columns 
                        if col.startswith('population_') 
                        and col != 'population']
-    
-    # Fill missing population values with sum of demographic columns
-    processed_df['population'] = processed_df['population'].fillna(
-        processed_df[demographic_cols].sum(axis=1)
-    )
-    
-    # Create total male population column
-    male_cols = [col for col in df.columns if col.startswith('population_m')]
-    processed_df['total_male'] = processed_df[male_cols].sum(axis=1).round().astype(int)
-    
-    # Create total female population column
-    female_cols = [col for col in df.columns if col.startswith('population_f')]
-    processed_df['total_female'] = processed_df[female_cols].sum(axis=1).round().astype(int)
+    block = df[demographic_cols].to_numpy(dtype=np.float32)
+    male_mask = np.array([col.startswith('population_m') for col in demographic_cols])
+    female_mask = np.array([col.startswith('population_f') for col in demographic_cols])
 
-    processed_df.rename(columns={'population': 'total_population'}, inplace=True)
-    processed_df.drop('geometry', axis=1, inplace=True)
-
-    total_pop, sum_gender, matching_rows = get_pop_total_and_sum(processed_df)
-
-    print(f"Number of rows where total population equals sum of gender totals: {matching_rows}")
-
-    # negative value indicates that the sum is bigger than the recorded total pop from first dataset 
-    # positive value indicates that the recorded total pop from first dataset is bigger than the sum
-    processed_df['recorded_pop_diff'] = total_pop - sum_gender
+    columns = compute_population_columns(block, df['population'].to_numpy(dtype=np.float64),
+                                         male_mask, female_mask, chunk_size)
 
-    #Update the total_population to capture the max number of population 
-    # Do this before update to keep the original difference recorded
-    # Create the condition where sum is bigger than total population
-    condition = (processed_df['total_male'] + processed_df['total_female']) > processed_df['total_population']
+    # Build the output without copying the demographic columns more than once
+    processed_df = df.drop(columns=['geometry'], errors='ignore').rename(columns={'population': 'total_population'})
+    for column in ['total_population', 'total_male', 'total_female', 'recorded_pop_diff']:
+        processed_df[column] = columns[column]
 
-    # Replace population where condition is True
-    processed_df.loc[condition, 'total_population'] = processed_df.loc[condition, 'total_male'] + processed_df.loc[condition, 'total_female']
-    total_pop, sum_gender, matching_rows = get_pop_total_and_sum(processed_df)
-    print(f"Number of rows where total population equals sum of gender totals after update: {matching_rows}")
+    if verbose:
+        print(f"Number of rows where total population equals sum of gender totals: {columns['matching_rows_before']}")
+        print(f"Number of rows where total population equals sum of gender totals after update: {columns['matching_rows_after']}")
     return processed_df
 
 
 def merge_and_process_age_demographics_and_pop(population_df, age_demographics_df):
-    def get_h3_center(h3_index):
-        # h3.h3_to_geo returns (lat, lng)
-        lat, lng = h3.h3_to_geo(h3_index)
-        return pd.Series({'latitude': lat, 'longitude': lng})
-    
     print('[INFO] Merging and processing age demographics and population data...')
-    population_df = population_df.to_crs(epsg=4326)
-    df_merged = age_demographics_df.merge(population_df, on='h3', how='left')
+    df_merged = left_join_on_h3(age_demographics_df, population_df)
     print('[INFO] Merging Complete!')
     df_merged_clean = process_population_data(df_merged)
     
-    # Apply the function to create new columns
-    df_merged_clean[['latitude', 'longitude']] = df_merged_clean['h3'].apply(get_h3_center)
+    # Compute the centers of all the hexagons at once (memoized for the next stages)
+    df_merged_clean['latitude'], df_merged_clean['longitude'] = h3_to_geo_array(df_merged_clean['h3'].to_numpy())
     print('[INFO] Processing Complete!')
     return df_merged_clean
 
 
-def main():
-    age_demographics_df = load_age_demographics()
+def merge_and_process_in_chunks(population_df, export_filepath, chunk_size=POPULATION_CHUNK_SIZE):
+    """
+    Chunked variant of merge_and_process_age_demographics_and_pop: the age demographics csv is
+    streamed chunk_size rows at a time, and every chunk is merged, processed and appended to the
+    export file. Only the age demographics side is bounded by the chunk size, the population
+    data is kept in memory in full (sorted once by h3 cell, for all the chunks).
+
+    Parameters:
+    population_df (pandas.DataFrame): Population data with uint64 h3 cells
+    export_filepath (str): Path of the csv file to write
+    chunk_size (int): Number of rows processed at a time
+    """
+    print('[INFO] Merging and processing age demographics and population data in chunks...')
+    file_path = os.path.join(PROCESSED_DATA_DIR, 'KEN_agesex_aggregated.csv')
+    matching_rows_before = matching_rows_after = 0
+    header = True
+    population_df = population_df.sort_values('h3', kind='stable', ignore_index=True)
+    for age_demographics_chunk in pd.read_csv(file_path, chunksize=chunk_size):
+        age_demographics_chunk['h3'] = h3_to_int_array(age_demographics_chunk['h3'])
+        df_merged = left_join_on_h3(age_demographics_chunk, population_df, presorted=True)
+        df_merged_clean = process_population_data(df_merged, chunk_size, verbose=False)
+        df_merged_clean['latitude'], df_merged_clean['longitude'] = h3_to_geo_array(df_merged_clean['h3'].to_numpy())
+
+        sum_gender = df_merged_clean['total_male'] + df_merged_clean['total_female']
+        matching_rows_before += int((df_merged_clean['recorded_pop_diff'] == 0).sum())
+        matching_rows_after += int((df_merged_clean['total_population'].round().astype(int) == sum_gender).sum())
+
+        if EXPORT_H3_AS_STRING:
+            df_merged_clean = h3_column_to_str(df_merged_clean)
+        df_merged_clean.to_csv(export_filepath, index=False, mode='w' if header else 'a', header=header)
+        header = False
+
+    print(f"Number of rows where total population equals sum of gender totals: {matching_rows_before}")
+    print(f"Number of rows where total population equals sum of gender totals after update: {matching_rows_after}")
+    print(f"[INFO] Merged dataframe of age demographics and population successfully saved to {export_filepath}")
+
+def main(chunked=False):
     population_df = load_population()
-    age_demographics_pop_df = merge_and_process_age_demographics_and_pop(population_df, age_demographics_df)
 
     # Defining the export file path to save the dataframe
     export_filepath = os.path.join(PROCESSED_DATA_DIR, 'KEN_population_age_demographics_merged.csv')
+    if chunked:
+        merge_and_process_in_chunks(population_df, export_filepath)
+        return
+
+    age_demographics_df = load_age_demographics()
+    age_demographics_pop_df = merge_and_process_age_demographics_and_pop(population_df, age_demographics_df)
 
     # Attempting to save the dataframe
     try:
+        if EXPORT_H3_AS_STRING:
+            age_demographics_pop_df = h3_column_to_str(age_demographics_pop_df)
         age_demographics_pop_df.to_csv(export_filepath, index=False)
         print(f"[INFO] Merged dataframe of age demographics and population successfully saved to {export_filepath}")
     except Exception as e:
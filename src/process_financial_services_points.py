@@ -1,8 +1,13 @@
 import geopandas as gpd 
 import pandas as pd
 import os
-from geopy.geocoders import Nominatim
-import time
+import re
+import pyogrio
+import numpy as np
+from scipy.spatial import cKDTree
+from reverse_geocoding import ReverseGeocoder
+from h3_utils import to_unit_vectors, km_to_chord
+from process_points_of_interest import POINTS_OF_INTEREST_DIR
 
 RAW_DATA_DIR = '../../data/raw'
 PROCESSED_DATA_DIR = '../../data/processed'
@@ -10,16 +15,81 @@ PROCESSED_DATA_DIR = '../../data/processed'
 # Directory where the gpkg file for the financial services points is saved
 FIN_POINTS_DIR = 'ken_financial_services_points'
 
+# Columns of the financial services points that are not exported, and never read from the file
+FIN_POINTS_DROPPED_COLUMNS = ['name:en', 'operator', 'network', 'addr:full', 'addr:city', 'source', 'name:sw']
+
+# Maximum distance (meters) to the named feature a missing name is taken from
+OFFLINE_NAME_TOLERANCE_M = 50
+
+# Whether to look up the names still missing after the offline backfill with Nominatim
+USE_REMOTE_NAME_LOOKUP = False
+
+# Rules standardizing the bank names, as (pattern, standard name), applied in this order. A name
+# matching a pattern (case insensitive, anywhere in the name) is replaced by the standard name,
+# and the next rules see the replaced name. Patterns can also be given as compiled regexes.
+BANK_NAME_RULES = [
+    (re.compile(r'\AK C B\Z'), 'KCB Bank'),
+    ('KCB', 'KCB Bank'),
+    ('Kenya Commercial Bank', 'KCB Bank'),
+    ('Stanbic', 'Stanbic Bank'),
+    ('Family Bank', 'Family Bank'),
+    ('Commercial Bank of', 'Commercial Bank of Africa'),
+    ('Bank of Africa', 'Commercial Bank of Africa'),
+    ('NIC Bank Limited', 'Commercial Bank of Africa'),
+    ('CBK', 'Cooperative Bank of Kenya'),
+    ('Cooperative Bank', 'Cooperative Bank of Kenya'),
+    ('Co-operative Bank', 'Cooperative Bank of Kenya'),
+    ('I&M', 'I&M Bank'),
+    ('Post Bank', 'Kenya Post Office Savings Bank'),
+    ('Postbank', 'Kenya Post Office Savings Bank'),
+    ('Chase', 'Chase Bank'),
+    ('ChaseBank', 'Chase Bank'),
+    ('KWFT', 'Kenya Women Finance Trust'),
+    ('Kenya Women Finance Trust', 'Kenya Women Finance Trust'),
+    ('Trans National Bank', 'Access Bank Kenya'),
+    ('National Bank', 'National Bank of Kenya'),
+    ('Equity', 'Equity Bank'),
+    ('Barclays', 'Barclays Bank'),
+    ('Barcalys', 'Barclays Bank'),
+    ('Co-Op Bank', 'Co-operative Bank of Kenya'),
+    ('Co-op', 'Co-operative Bank of Kenya'),
+    ('Co-', 'Co-operative Bank of Kenya'),
+    ('Co operative', 'Co-operative Bank of Kenya'),
+    ('Co -', 'Co-operative Bank of Kenya'),
+    ('Co Op Bank', 'Co-operative Bank of Kenya'),
+    ('Co Op', 'Co-operative Bank of Kenya'),
+    ('Coop Bank', 'Co-operative Bank of Kenya'),
+    ('Ecobank', 'EcoBank'),
+    ('Absa', 'Absa Bank'),
+    ('DAIMOND', 'Diamond Trust Bank Group'),
+    ('DTB', 'Diamond Trust Bank Group'),
+    ('Diamond Trust Bank', 'Diamond Trust Bank Group'),
+    ('Sacco', 'Savings and Credit Cooperative Organization'),
+    ('M-Pesa', 'M-Pesa Point'),
+    ('mpesa', 'M-Pesa Point'),
+    ('Pesa', 'M-Pesa Point'),
+    ('psea', 'M-Pesa Point'),
+    ('Kenya Women Finance', 'Kenya Women Finance Trust'),
+    ('Kenya Woman Finance', 'Kenya Women Finance Trust'),
+    ('Kenya Women Micro', 'Kenya Women Microfinance Bank'),
+    ('Kenya Woman Micro', 'Kenya Women Microfinance Bank'),
+    # Rename all variations to "Posta" (post office)
+    ('Posta', 'POSTA'),
+]
+
 def load_financial_services_points():
     print('[INFO] Attempting to load financial services points gpkg file...')
     file_name = 'ken_financial_services_points.gpkg'
     file_path = os.path.join(RAW_DATA_DIR, FIN_POINTS_DIR, file_name)
-    financial_services_points = gpd.read_file(file_path)
+    # The column list is pushed down to the GeoPackage read, so the dropped columns are never parsed
+    columns = [column for column in pyogrio.read_info(file_path)['fields'] if column not in FIN_POINTS_DROPPED_COLUMNS]
+    financial_services_points = gpd.read_file(file_path, engine='pyogrio', columns=columns)
     print('f[INFO] File found at {file_path}')
     print('f[INFO] Counties shapes loaded successfully!\n')
-    financial_services_points.drop(['name:en', 'operator', 'network', 'addr:full', 'addr:city', 'source', 'name:sw'], axis=1, inplace=True)
     financial_services_points = extract_coordinates_from_geometry(financial_services_points)
-    financial_services_points = lookup_places_osm(financial_services_points)
+    financial_services_points = fill_names_from_named_features(financial_services_points)
+    if USE_REMOTE_NAME_LOOKUP:
+        financial_services_points = lookup_places_osm(financial_services_points)
     financial_services_points = process_names(financial_services_points)
     financial_services_points['name'] = financial_services_points['name'].fillna('Name Not Listed')
     
@@ -48,155 +118,143 @@ def extract_coordinates_from_geometry(gdf):
     
     return gdf
 
-def lookup_places_osm(df):
+def load_named_features():
+    """
+    Load the coordinates and names of the named points of interest. The filter on the names is
+    pushed down to the GeoPackage read, so only the named features are parsed.
+    """
+    file_path = os.path.join(RAW_DATA_DIR, POINTS_OF_INTEREST_DIR, 'ken_points_of_interest_points.gpkg')
+    named_points = gpd.read_file(file_path, engine='pyogrio', columns=['name'], where='"name" IS NOT NULL')
+    centroids = named_points.geometry.centroid
+    print(f'[INFO] Loaded {len(named_points)} named points of interest from {file_path}')
+    return pd.DataFrame({'name': named_points['name'], 'latitude': centroids.y, 'longitude': centroids.x})
+
+def fill_names_from_named_features(df, named_features=None, tolerance_m=OFFLINE_NAME_TOLERANCE_M):
+    """
+    Fill the missing names with the name of the nearest named feature within tolerance_m meters,
+    without any network request. The named features are the named points of interest and the
+    named financial services points themselves, indexed in a KD-tree queried for all the
+    unnamed points at once.
+
+    Parameters:
+    df (DataFrame): Points with 'name', 'latitude' and 'longitude' columns
+    named_features (DataFrame): Named features to use, by default loaded with load_named_features
+    tolerance_m (float): Maximum distance (meters) to the named feature
+
+    Returns:
+    DataFrame: Copy of df with the names found filled
+    """
+    if named_features is None:
+        named_features = load_named_features()
+    named = df['name'].notna()
+    references = pd.concat([named_features, df.loc[named, ['name', 'latitude', 'longitude']]], ignore_index=True)
+    references = references.dropna(subset=['name', 'latitude', 'longitude'])
+
+    df = df.copy()
+    unnamed = df['name'].isna() & df['latitude'].notna() & df['longitude'].notna()
+    print(f"Null values in the name column before the offline backfill = {df['name'].isna().sum()}")
+    if unnamed.any() and len(references) > 0:
+        tree = cKDTree(to_unit_vectors(references['latitude'].to_numpy(), references['longitude'].to_numpy()))
+        _, nearest = tree.query(
+            to_unit_vectors(df.loc[unnamed, 'latitude'].to_numpy(), df.loc[unnamed, 'longitude'].to_numpy()),
+            k=1, distance_upper_bound=km_to_chord(tolerance_m / 1000)
+        )
+        # Points without a named feature within the tolerance get the index len(references)
+        found = nearest < len(references)
+        df.loc[df.index[unnamed][found], 'name'] = references['name'].to_numpy()[nearest[found]]
+    print(f"Null values in the name column after the offline backfill = {df['name'].isna().sum()}\n")
+    return df
+
+def lookup_places_osm(df, geocoder=None):
     """
     Look up place names using OpenStreetMap's Nominatim for coordinates with missing names.
+    The addresses are cached on disk, so a new run only requests the points not looked up yet.
+
+    Parameters:
+    df (DataFrame): Points with 'name', 'latitude' and 'longitude' columns
+    geocoder (ReverseGeocoder): Geocoder to use, by default one sending requests to Nominatim
     """
-    # Initialize geocoder
-    geolocator = Nominatim(user_agent="ken_financial_services_points_app")
-    
+    own_geocoder = geocoder is None
+    if own_geocoder:
+        geocoder = ReverseGeocoder()
+
     df = df.copy()
-    count = 0
     count_null_names_before = df['name'].isna().sum()
     print('[INFO] Attempting to fill out the null names in the financial services...')
-    for idx in df[df['name'].isna()].index:
-        lat = df.loc[idx, 'latitude']
-        lng = df.loc[idx, 'longitude']
-        
-        try:
-            # Reverse geocode the coordinates
-            location = geolocator.reverse(f"{lat}, {lng}", exactly_one=True)
-            
-            if location:
-                # Extract the name from address data
-                address = location.raw.get('address', {})
-                print(f"Address extracted = {address}")
-                if 'amenity' in address:
-                    print(f'[INFO] Amenity Name found!\n')
-                    df.loc[idx, 'name'] = address['amenity']
-            
-            # Sleep to respect rate limits
-            time.sleep(1)  # OpenStreetMap requires slower rates
-            
-            count += 1
-            if count % 5 == 0:
-                print(f"Processed {count} locations")
-                
-        except Exception as e:
-            print(f"Error processing coordinates ({lat}, {lng}): {str(e)}")
-            continue
+    unnamed_index = df.index[df['name'].isna()]
+    coordinates = list(zip(df.loc[unnamed_index, 'latitude'], df.loc[unnamed_index, 'longitude']))
+    try:
+        addresses = geocoder.reverse_many(coordinates)
+    finally:
+        if own_geocoder:
+            geocoder.close()
+
+    # Extract the name from address data
+    for idx, address in zip(unnamed_index, addresses):
+        if address and 'amenity' in address:
+            df.loc[idx, 'name'] = address['amenity']
     
     count_null_names_after = df['name'].isna().sum()
     print(f"Null values in the name column before processing = {count_null_names_before}")
     print(f"Null values in the name column after processing = {count_null_names_after}\n")
     return df
 
-# Function to standardize bank names
-def standardize_bank_name(df, pattern, standard_name):
+def compile_bank_name_rules(rules=None):
     """
-    Standardize bank names based on a pattern.
-    
-    Parameters:
-    df: DataFrame containing bank names
-    pattern: String pattern to match (e.g., 'KCB')
-    standard_name: Name to replace matches with (e.g., 'KCB Bank')
+    Compile the bank name rules into a list of (regex, standard name). The patterns given as
+    strings are matched anywhere in the name and ignore the case, like str.contains(case=False).
     """
-    if (type(pattern) == str):
-        # Show current variations
-        print(f"Current variations of names containing '{pattern}':")
-        print(df[df['name'].str.contains(pattern, case=False, na=False)]['name'].unique())
-        
-        # Standardize the name
-        df.loc[df['name'].str.contains(pattern, case=False, na=False), 'name'] = standard_name
-        
-        # Verify the change
-        print(f"\nAfter standardization - all matched entries now show as '{standard_name}'")
-        print(df[df['name'].str.contains(pattern, case=False, na=False)]['name'].unique())
-    
-    else:
-        print("Processing multiple patterns at once")
-        for pat in pattern:
-            # Show current variations
-            print(f"Current variations of names containing '{pat}':")
-            print(df[df['name'].str.contains(pat, case=False, na=False)]['name'].unique())
-            
-            # Standardize the name
-            df.loc[df['name'].str.contains(pat, case=False, na=False), 'name'] = standard_name
-            
-            # Verify the change
-            print(f"\nAfter standardization - all matched entries now show as '{standard_name}'")
-            print(df[df['name'].str.contains(pat, case=False, na=False)]['name'].unique())
-
-    
-    return df
-
-def process_names(financial_services_points):
-    # Renaming banks since a lot of them represent the same bank 
-    financial_services_points.loc[financial_services_points['name'] == 'K C B', 'name'] = 'KCB Bank'
-    financial_services_points = standardize_bank_name(financial_services_points, 'KCB', 'KCB Bank')
-    financial_services_points = standardize_bank_name(financial_services_points, 'Kenya Commercial Bank', 'KCB Bank')
-
-    financial_services_points = standardize_bank_name(financial_services_points, 'Stanbic', 'Stanbic Bank')
-    financial_services_points = standardize_bank_name(financial_services_points, 'Family Bank', 'Family Bank')
-
-    financial_services_points = standardize_bank_name(financial_services_points, 'Commercial Bank of', 'Commercial Bank of Africa')
-    financial_services_points = standardize_bank_name(financial_services_points, 'Bank of Africa', 'Commercial Bank of Africa')
-    financial_services_points = standardize_bank_name(financial_services_points, 'NIC Bank Limited', 'Commercial Bank of Africa')
-
-    financial_services_points = standardize_bank_name(financial_services_points, 'CBK', 'Cooperative Bank of Kenya') 
-    financial_services_points = standardize_bank_name(financial_services_points, 'Cooperative Bank', 'Cooperative Bank of Kenya') 
-    financial_services_points = standardize_bank_name(financial_services_points, 'Co-operative Bank', 'Cooperative Bank of Kenya')
-
-    financial_services_points = standardize_bank_name(financial_services_points, 'I&M', 'I&M Bank')
-
-    financial_services_points = standardize_bank_name(financial_services_points, 'Post Bank', 'Kenya Post Office Savings Bank')
-    financial_services_points = standardize_bank_name(financial_services_points, 'Postbank', 'Kenya Post Office Savings Bank')
-
-    financial_services_points = standardize_bank_name(financial_services_points, 'Chase', 'Chase Bank')
-    financial_services_points = standardize_bank_name(financial_services_points, 'ChaseBank', 'Chase Bank')
-
-    financial_services_points = standardize_bank_name(financial_services_points, 'KWFT', 'Kenya Women Finance Trust')
-    financial_services_points = standardize_bank_name(financial_services_points, 'Kenya Women Finance Trust', 'Kenya Women Finance Trust')
-
-    financial_services_points = standardize_bank_name(financial_services_points, 'Trans National Bank', 'Access Bank Kenya')
-
-    financial_services_points = standardize_bank_name(financial_services_points, 'National Bank', 'National Bank of Kenya')
-
-    financial_services_points = standardize_bank_name(financial_services_points, 'Equity', 'Equity Bank')
-
-    financial_services_points = standardize_bank_name(financial_services_points, 'Barclays', 'Barclays Bank')
-    financial_services_points = standardize_bank_name(financial_services_points, 'Barcalys', 'Barclays Bank')
-
-
-    financial_services_points = standardize_bank_name(financial_services_points, 'Co-Op Bank', 'Co-operative Bank of Kenya')
-    financial_services_points = standardize_bank_name(financial_services_points, 'Co-op', 'Co-operative Bank of Kenya')
-    financial_services_points = standardize_bank_name(financial_services_points, 'Co-', 'Co-operative Bank of Kenya')
-    financial_services_points = standardize_bank_name(financial_services_points, ['Co operative', 'Co -', 'Co Op Bank', 'Co Op', 'Coop Bank'], 'Co-operative Bank of Kenya')
-
-    financial_services_points = standardize_bank_name(financial_services_points, 'Ecobank', 'EcoBank')
-
-    financial_services_points = standardize_bank_name(financial_services_points, 'Absa', 'Absa Bank')
-
-
-    financial_services_points = standardize_bank_name(financial_services_points, 'DAIMOND', 'Diamond Trust Bank Group')
-    financial_services_points = standardize_bank_name(financial_services_points, 'DTB', 'Diamond Trust Bank Group')
-    financial_services_points = standardize_bank_name(financial_services_points, 'Diamond Trust Bank', 'Diamond Trust Bank Group')
-
-    financial_services_points = standardize_bank_name(financial_services_points, 'Sacco', 'Savings and Credit Cooperative Organization')
-
-    financial_services_points = standardize_bank_name(financial_services_points, 'M-Pesa', 'M-Pesa Point')
-    financial_services_points = standardize_bank_name(financial_services_points, 'mpesa', 'M-Pesa Point')
-    financial_services_points = standardize_bank_name(financial_services_points, ['Pesa', 'psea'], 'M-Pesa Point')
+    rules = BANK_NAME_RULES if rules is None else rules
+    compiled_rules = []
+    for pattern, standard_name in rules:
+        if isinstance(pattern, str):
+            pattern = re.compile(pattern, re.IGNORECASE)
+        compiled_rules.append((pattern, standard_name))
+    return compiled_rules
+
+def normalize_name(name, compiled_rules, matches=None):
+    """
+    Apply the rules to a name in order, every rule seeing the name left by the previous ones.
+    The names changed by every rule are collected in matches when given.
+    """
+    if not isinstance(name, str):
+        return name
+    for rule_index, (pattern, standard_name) in enumerate(compiled_rules):
+        if pattern.search(name):
+            if matches is not None and name != standard_name:
+                matches.setdefault(rule_index, set()).add(name)
+            name = standard_name
+    return name
+
+def process_names(financial_services_points, rules=None, verbose=False):
+    """
+    Standardize the bank names, since a lot of them represent the same bank.
 
-    financial_services_points = standardize_bank_name(financial_services_points, ['Kenya Women Finance', 'Kenya Woman Finance'], 'Kenya Women Finance Trust')
-    financial_services_points = standardize_bank_name(financial_services_points, ['Kenya Women Micro', 'Kenya Woman Micro'], 'Kenya Women Microfinance Bank')
+    The rules are only applied to the distinct names, and the results are mapped back to the
+    points by the code of their name.
 
-    # Rename all variations to "Posta" (post office)
-    financial_services_points.loc[financial_services_points['name'].str.contains('Posta', case=False, na=False), 'name'] = 'POSTA'
+    Parameters:
+    financial_services_points (DataFrame): Points with a 'name' column
+    rules (list): (pattern, standard name) rules applied in order, BANK_NAME_RULES by default
+    verbose (bool): Whether to print the names changed by every rule, for audits
 
+    Returns:
+    DataFrame: The points with the standardized names
+    """
+    compiled_rules = compile_bank_name_rules(rules)
+    codes, names = pd.factorize(financial_services_points['name'])
+    matches = {} if verbose else None
+    normalized_names = np.array([normalize_name(name, compiled_rules, matches) for name in names], dtype=object)
+
+    named = codes >= 0
+    financial_services_points.loc[named, 'name'] = normalized_names[codes[named]]
+
+    if verbose:
+        for rule_index, variations in sorted(matches.items()):
+            pattern, standard_name = compiled_rules[rule_index]
+            print(f"Names matching '{pattern.pattern}' standardized as '{standard_name}': {sorted(variations)}")
     return financial_services_points
 
-
 def main():
     financial_services_points = load_financial_services_points()
 
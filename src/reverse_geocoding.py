@@ -0,0 +1,143 @@
+'''
+This script contains the reverse geocoding used to fill the missing names of the points.
+Addresses are persisted in an on-disk cache keyed by the rounded coordinates, so an interrupted
+run resumes where it stopped and the points already looked up are never requested again.
+Requests are sent by a pool of threads sharing a token bucket, which keeps the request budget
+of the endpoint fully used without exceeding it.
+'''
+import threading
+import time
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import diskcache
+from geopy.geocoders import Nominatim
+
+# Nominatim endpoint, can be pointed to any server implementing its /reverse API (e.g. a local stub)
+NOMINATIM_ENDPOINT = 'https://nominatim.openstreetmap.org'
+USER_AGENT = 'ken_financial_services_points_app'
+
+# Directory of the persistent cache of the addresses
+REVERSE_GEOCODING_CACHE_DIR = '../output/reverse_geocoding_cache'
+
+# OpenStreetMap's Nominatim allows at most one request per second
+REQUESTS_PER_SECOND = 1.0
+
+# Number of threads sending the requests, so that the latency of a request does not delay the next ones
+GEOCODING_WORKERS = 4
+
+# Number of decimals the coordinates are rounded to in the cache keys (about 1m)
+COORDINATE_PRECISION = 5
+
+class TokenBucket:
+    """
+    Thread-safe token bucket limiting the rate of the requests.
+
+    Tokens are added at rate per second, up to capacity. Every request takes a token, waiting
+    for one to be added when the bucket is empty.
+    """
+    def __init__(self, rate=REQUESTS_PER_SECOND, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, blocking until one is available."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class ReverseGeocoder:
+    """
+    Reverse geocoder with a persistent cache, a rate limit and concurrent requests.
+
+    Parameters:
+    endpoint (str): Base URL of the Nominatim compatible server
+    cache_dir (str): Directory of the persistent cache of the addresses
+    requests_per_second (float): Maximum rate of the requests sent to the endpoint
+    workers (int): Number of threads sending the requests
+    precision (int): Number of decimals the coordinates are rounded to in the cache keys
+    user_agent (str): User agent sent with the requests
+    timeout (float): Timeout of a request, in seconds
+    """
+    def __init__(self, endpoint=NOMINATIM_ENDPOINT, cache_dir=REVERSE_GEOCODING_CACHE_DIR,
+                 requests_per_second=REQUESTS_PER_SECOND, workers=GEOCODING_WORKERS,
+                 precision=COORDINATE_PRECISION, user_agent=USER_AGENT, timeout=10):
+        url = urlsplit(endpoint)
+        self.geolocator = Nominatim(
+            domain=url.netloc + url.path.rstrip('/'), scheme=url.scheme or 'https',
+            user_agent=user_agent, timeout=timeout
+        )
+        self.cache = diskcache.Cache(cache_dir)
+        self.bucket = TokenBucket(requests_per_second)
+        self.workers = workers
+        self.precision = precision
+
+    def get_cache_key(self, lat, lng):
+        return f'{round(float(lat), self.precision)},{round(float(lng), self.precision)}'
+
+    def reverse(self, lat, lng):
+        """
+        Returns the address of a point as a dict (empty when the endpoint found nothing).
+        Errors are raised and not cached, so that the point is requested again on the next run.
+        """
+        key = self.get_cache_key(lat, lng)
+        address = self.cache.get(key)
+        if address is not None:
+            return address
+
+        self.bucket.acquire()
+        location = self.geolocator.reverse(f"{lat}, {lng}", exactly_one=True)
+        address = location.raw.get('address', {}) if location else {}
+        self.cache.set(key, address)
+        return address
+
+    def reverse_many(self, coordinates, verbose=True):
+        """
+        Reverse geocode many points concurrently, the cached ones without any request.
+
+        Parameters:
+        coordinates (list): (lat, lng) pairs
+        verbose (bool): Whether to print the progress
+
+        Returns:
+        list: Address of every point (None for the points whose request failed)
+        """
+        addresses = [None] * len(coordinates)
+        pending = []
+        for position, (lat, lng) in enumerate(coordinates):
+            address = self.cache.get(self.get_cache_key(lat, lng))
+            if address is None:
+                pending.append(position)
+            else:
+                addresses[position] = address
+        if verbose:
+            print(f'[INFO] {len(coordinates) - len(pending)} points found in the cache, {len(pending)} to request')
+
+        count = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.reverse, *coordinates[position]): position for position in pending}
+            for future in as_completed(futures):
+                position = futures[future]
+                try:
+                    addresses[position] = future.result()
+                except Exception as e:
+                    lat, lng = coordinates[position]
+                    print(f"Error processing coordinates ({lat}, {lng}): {str(e)}")
+                    continue
+
+                count += 1
+                if verbose and count % 50 == 0:
+                    print(f"Processed {count} locations")
+        return addresses
+
+    def close(self):
+        self.cache.close()